@@ -0,0 +1,55 @@
+import os
+import shutil
+import hashlib
+
+
+class ArtifactCache:
+    """
+        Tool outputs (MZmine csv and project, Morpheus summary and PSMs) stored by content key
+        The key is a hash of the raw file (see ProcessRawFile.get_artifact_key), the tool configuration and
+        the tool version, so reprocessing an unchanged raw file restores the outputs instead of running the tool
+        Used by ProcessRawFile
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_key(self, tool, *parts):
+        # parts are strings (hashes, config text, versions) that decide the tool output
+        md5 = hashlib.md5()
+        for part in parts:
+            md5.update(part.encode())
+            md5.update(b"\0")
+        return tool + "\\" + md5.hexdigest()
+
+    def restore(self, key, files):
+        # files is {cached name: path}, copies the cached outputs to their paths, False if not cached
+        entry = self.cache_dir + "\\" + key
+        if not os.path.isdir(entry):
+            return False
+
+        for name in files:
+            if not os.path.isfile(entry + "\\" + name):
+                return False
+
+        for name in files:
+            if not os.path.isdir(os.path.dirname(files[name])):
+                os.makedirs(os.path.dirname(files[name]))
+            shutil.copyfile(entry + "\\" + name, files[name])
+        return True
+
+    def store(self, key, files):
+        # copied to a temp folder then renamed so a partly written entry is never restored
+        entry = self.cache_dir + "\\" + key
+        if os.path.isdir(entry):
+            return
+
+        temp_dir = entry + "." + str(os.getpid()) + ".tmp"
+        try:
+            os.makedirs(temp_dir)
+            for name in files:
+                shutil.copyfile(files[name], temp_dir + "\\" + name)
+            os.replace(temp_dir, entry)
+        except Exception as e:
+            print(e)
+            print("Could not cache " + key)
+            shutil.rmtree(temp_dir, ignore_errors=True)
@@ -20,7 +20,7 @@ class Chromatogram:
         self.machine = machine
         self.fs = filesystem
         self.db = db
-        self.db.db.commit()  # commit for any other instances
+        self.db.commit()  # commit for any other instances
         self.run_id = self.db.get_run_id(self.file_name)
         self.outfiles_dir = self.fs.out_dir + "\\" + self.experiment + "\\" + self.machine + "\\" + self.file_name
         self.path = self.outfiles_dir + "\\" + self.file_name + ".mzmine"
@@ -317,11 +317,11 @@ class Chromatogram:
                     "','" + str(c_id) + "')"
 
             try:
-                self.db.cursor.execute(sql)
+                self.db.execute(sql)
             except Exception as e:
                 print(e)
 
-            self.db.db.commit()
+            self.db.commit()
 
     # PLOT with BINS (for testing)
     def plot_xic_chromatograms_new_zeros(self, peaksdict, scansfile, scansdict):
@@ -5,7 +5,118 @@ try:
     MySQLdb.install_as_MySQLdb()
 except ImportError:
     pass
+import os
 import logging
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+        Process-wide pool of MySQL connections, so processing a raw file doesn't open a new connection
+        A connection is pinged (reconnected if the server dropped it) when taken, rolled back when given back
+        and at most max_idle are kept open
+        A forked process starts its own pool as connections can't be shared between processes
+        Used by MPMFDBSetUp
+    """
+    pools = {}
+    lock = threading.Lock()
+
+    def __init__(self, user, password, database, max_idle=4):
+        self.user = user
+        self.password = password
+        self.database = database
+        self.max_idle = max_idle
+        self.idle = []
+        self.pid = os.getpid()
+        self.idle_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, user, password, database):
+        key = (user, database)
+        with cls.lock:
+            pool = cls.pools.get(key)
+            if pool is None or pool.pid != os.getpid():
+                pool = cls(user, password, database)
+                cls.pools[key] = pool
+        return pool
+
+    def take(self):
+        with self.idle_lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is not None:
+            try:
+                connection.ping(reconnect=True)
+                return connection
+            except Exception as e:
+                print(e)
+                self.discard(connection)
+        return MySQLdb.connect(host="localhost", user=self.user, password=self.password, db=self.database)
+
+    def give(self, connection):
+        # an uncommitted transaction isn't passed on to the next user
+        try:
+            connection.rollback()
+        except Exception as e:
+            print(e)
+            self.discard(connection)
+            return
+        with self.idle_lock:
+            if os.getpid() == self.pid and len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        self.discard(connection)
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except Exception as e:
+            print(e)
+
+
+class UnitOfWork:
+    """
+        The writes for one QC run, committed once on the run's connection or all rolled back
+        Writes on the run's connection go straight into its open transaction, writes from connections
+        that join (the ThermoMetrics and Chromatogram stage threads) are staged and replayed before the commit
+        A unit without a connection only stages writes, for a run not inserted yet (see staged_run)
+        Used by MPMFDBSetUp (see unit_of_work)
+    """
+    RUN_ID = "@run_id" # the id of a run not inserted yet in staged writes, replaced by add
+
+    def __init__(self, db=None):
+        self.db = db
+        self.staged = []
+        self.lock = threading.Lock()
+        self.failed = False
+        self.committed = False
+
+    def stage(self, sql, args=None):
+        with self.lock:
+            self.staged.append((sql, args))
+
+    def fail(self):
+        # rolled back at the end of the unit
+        self.failed = True
+
+    def add(self, unit, run_id):
+        # the writes staged by a unit without a connection, for the run inserted in this one
+        with self.lock:
+            for sql, args in unit.staged:
+                self.staged.append((sql.replace(self.RUN_ID, str(run_id)), args))
+
+    def flush(self):
+        # a row the database rejects (eg. a nan value or unknown component) is skipped, as when each row was
+        # committed on its own, a lost connection or deadlock ends the transaction so rolls the run back
+        with self.lock:
+            for sql, args in self.staged:
+                try:
+                    self.db.cursor.execute(sql, args)
+                except Exception as e:
+                    if isinstance(e, MySQLdb.OperationalError):
+                        raise
+                    print(e)
+            self.staged = []
 
 
 class MPMFDBSetUp:
@@ -16,8 +127,16 @@ class MPMFDBSetUp:
         Refer to QC ER Diagram for design
         https://realpython.com/documenting-python-code/#documenting-your-python-code-base-using-docstrings
     """
-
-    # CONSTRUCTOR connects to database as user with pword
+    # name: id for the reference tables, loaded on first use and shared by every connection in the process
+    # run holds file_name: run_id and is filled one file at a time, see invalidate
+    ID_TABLES = {"metric": "SELECT metric_name, metric_id FROM metric ORDER BY metric_id",
+                 "component": "SELECT component_name, component_id FROM sample_component ORDER BY component_id",
+                 "exp_mass_charge": "SELECT component_name, exp_mass_charge FROM sample_component ORDER BY component_id",
+                 "machine": "SELECT machine_name, machine_id FROM machine ORDER BY machine_id",
+                 "experiment": "SELECT LOWER(experiment_type), experiment_id FROM experiment ORDER BY experiment_id"}
+    id_cache = {}
+
+    # CONSTRUCTOR connects to database as user with pword (a connection from the process's pool)
     def __init__(self, user, pword, database, filesystem):
         self.username = user
         self.password = pword
@@ -25,14 +144,127 @@ class MPMFDBSetUp:
         self.fs = filesystem
         self.create_logger()
         self.connected = False
+        self.unit = None
+        self.locks = set()
         try:
-            self.db = MySQLdb.connect(host="localhost", user=self.username, password=self.password, db=self.database)
+            self.pool = ConnectionPool.get(self.username, self.password, self.database)
+            self.db = self.pool.take()
             self.cursor = self.db.cursor()
             #self.logger.warning("Database Connection Success")
             self.connected = True
         except Exception as e:
             self.logger.exception(e)
 
+    def get_lock(self, name, timeout=600):
+        # MySQL advisory lock held by this connection, waits up to timeout seconds
+        # released by release_lock, close, or by MySQL if the process dies
+        try:
+            self.cursor.execute("SELECT GET_LOCK(%s, %s)", (name[:64], timeout))
+            if self.cursor.fetchone()[0] == 1:
+                self.locks.add(name)
+                return True
+            return False
+        except Exception as e:
+            self.logger.exception(e)
+            return False
+
+    def release_lock(self, name):
+        try:
+            self.cursor.execute("SELECT RELEASE_LOCK(%s)", (name[:64],))
+            self.cursor.fetchone()
+        except Exception as e:
+            self.logger.exception(e)
+        self.locks.discard(name)
+
+    # UNIT OF WORK
+    @contextmanager
+    def unit_of_work(self, file_name):
+        # everything written on this connection (and joined connections) inside is one transaction for the run
+        # of file_name, commit() is deferred to the end and rollback() or an exception rolls all of it back
+        unit = UnitOfWork(self)
+        self.unit = unit
+        try:
+            yield unit
+            if not unit.failed:
+                unit.flush()
+                self.db.commit()
+                unit.committed = True
+        finally:
+            self.unit = None
+            if not unit.committed:
+                try:
+                    self.db.rollback()
+                except Exception as e:
+                    self.logger.exception(e)
+                # the run id read inside the transaction doesn't exist any more (other files' ids, or their
+                # staged_run placeholders, are left alone)
+                self.invalidate("run", file_name)
+
+    @contextmanager
+    def staged_run(self, file_name):
+        # a unit without a connection for writes made before the run is inserted, connections that join it
+        # get UnitOfWork.RUN_ID as the run id, the writes are then added to the run's unit of work
+        unit = UnitOfWork()
+        MPMFDBSetUp.id_cache.setdefault("run", {})[file_name] = UnitOfWork.RUN_ID
+        try:
+            yield unit
+        finally:
+            self.invalidate("run", file_name)
+
+    def join(self, unit):
+        # stage this connection's writes in another connection's unit of work (None to leave it)
+        # ids written by the unit (eg. the run id) are only seen through the id cache
+        self.unit = unit
+
+    def execute(self, sql, args=None):
+        # a write, staged if this connection has joined another connection's unit of work
+        if self.unit is not None and self.unit.db is not self:
+            self.unit.stage(sql, args)
+        else:
+            self.cursor.execute(sql, args)
+
+    def commit(self):
+        if self.unit is None:
+            self.db.commit()
+
+    def rollback(self):
+        if self.unit is None:
+            self.db.rollback()
+        else:
+            self.unit.fail()
+
+    def ping(self):
+        # reconnect a long held connection (eg. watch mode) if the server has dropped it
+        # the server releases a dropped session's locks, so after a reconnect they are taken again,
+        # False if the connection or one of its locks can't be got back
+        try:
+            session = self.db.thread_id()
+            self.db.ping(reconnect=True)
+            reconnected = self.db.thread_id() != session
+        except Exception as e:
+            self.logger.exception(e)
+            return False
+
+        if reconnected:
+            for name in list(self.locks):
+                self.locks.discard(name)
+                if not self.get_lock(name, 0):
+                    print("Lost lock " + name + " on reconnect")
+                    return False
+        return True
+
+    def close(self):
+        # the connection goes back to the pool, without the locks it holds
+        if self.connected:
+            for name in list(self.locks):
+                self.release_lock(name)
+            try:
+                self.cursor.close()
+                self.pool.give(self.db)
+            except Exception as e:
+                self.logger.exception(e)
+            self.connected = False
+
     def set_up(self):
         self.drop_all_tables()
         self.create_all_tables()
@@ -47,6 +279,13 @@ class MPMFDBSetUp:
         # create class level logger as used in processing
         self.logger = logging.getLogger("DATABASE")
 
+        # handlers are added once per process, not per connection
+        with ConnectionPool.lock:
+            if self.logger.handlers:
+                return
+            self.add_log_handlers()
+
+    def add_log_handlers(self):
         # add handlers for file and console
         c_handler = logging.StreamHandler()
         f_handler = logging.FileHandler('database.log')
@@ -75,6 +314,8 @@ class MPMFDBSetUp:
         self.create_table_chromatogram()
         self.create_table_pressure_profile()
         self.create_table_threshold()
+        self.create_table_stage_ledger()
+        self.create_table_job_queue()
 
     def create_table_sample_component(self):
         sql = "CREATE TABLE IF NOT EXISTS sample_component (" \
@@ -246,6 +487,45 @@ class MPMFDBSetUp:
         except Exception as e:
             self.logger.exception(e)
 
+    def create_table_stage_ledger(self):
+        # completed processing stages per raw file, kept by file name so it survives qc_run deletes
+        sql = "CREATE TABLE IF NOT EXISTS stage_ledger (" \
+              "file_name VARCHAR(255) NOT NULL," \
+              "stage VARCHAR(32) NOT NULL," \
+              "completed_at DATETIME NOT NULL," \
+              "PRIMARY KEY(file_name, stage))"
+
+        try:
+            self.cursor.execute(sql)
+        except Exception as e:
+            self.logger.exception(e)
+
+    def create_table_job_queue(self):
+        # raw files shared between workers, see JobQueue
+        sql = "CREATE TABLE IF NOT EXISTS job_queue (" \
+              "job_id INT AUTO_INCREMENT NOT NULL," \
+              "file_name VARCHAR(255) NOT NULL," \
+              "raw_file VARCHAR(1024) NOT NULL," \
+              "machine VARCHAR(64) NOT NULL," \
+              "machine_type VARCHAR(32)," \
+              "experiment VARCHAR(32) NOT NULL," \
+              "venue VARCHAR(32) NOT NULL," \
+              "priority INT NOT NULL DEFAULT 0," \
+              "status VARCHAR(16) NOT NULL DEFAULT 'queued'," \
+              "attempts INT NOT NULL DEFAULT 0," \
+              "worker VARCHAR(128)," \
+              "lease_expires DATETIME," \
+              "heartbeat DATETIME," \
+              "queued_at DATETIME NOT NULL," \
+              "PRIMARY KEY(job_id)," \
+              "UNIQUE KEY(file_name)," \
+              "KEY(experiment, venue, status, priority))"
+
+        try:
+            self.cursor.execute(sql)
+        except Exception as e:
+            self.logger.exception(e)
+
     # DROP TABLES
     def drop_table(self, tablename):
         sql = "DROP TABLE " + tablename
@@ -258,7 +538,7 @@ class MPMFDBSetUp:
             
     def drop_all_tables(self):
         tables = ['measurement', 'stat', 'qc_run', 'sample_component', 'metric', 'machine', 'experiment',
-                  'pressure_profile', 'chromatogram']
+                  'pressure_profile', 'chromatogram', 'stage_ledger', 'job_queue']
         for table in tables:
             self.drop_table(table)
 
@@ -272,6 +552,8 @@ class MPMFDBSetUp:
         self.insert_machines()
         self.insert_thresholds_prot()
         self.insert_thresholds_metab()
+        # ids cached before the reference data was (re)inserted are stale
+        self.invalidate()
 
     def insert_components(self):
         # NOTE: exp_rt's are the default values
@@ -523,35 +805,57 @@ class MPMFDBSetUp:
             self.logger.exception(e)
 
     # GETS
+    def get_ids(self, table):
+        # name: id for one of ID_TABLES, read once per process (the first id wins for repeated names)
+        ids = MPMFDBSetUp.id_cache.get(table)
+        if ids is None:
+            try:
+                self.cursor.execute(self.ID_TABLES[table])
+                rows = self.cursor.fetchall()
+            except Exception as e:
+                self.logger.exception(e)
+                return {}
+            ids = {}
+            for name, row_id in rows:
+                ids.setdefault(name, row_id)
+            MPMFDBSetUp.id_cache[table] = ids
+        return ids
+
+    def invalidate(self, table=None, name=None):
+        # drop cached ids once the database changes: everything, one table or one name (eg. a deleted qc_run)
+        if table is None:
+            MPMFDBSetUp.id_cache.clear()
+        elif name is None:
+            MPMFDBSetUp.id_cache.pop(table, None)
+        else:
+            MPMFDBSetUp.id_cache.get(table, {}).pop(name, None)
+
     def get_run_id(self, datafile):
+        run_ids = MPMFDBSetUp.id_cache.setdefault("run", {})
+        if datafile in run_ids:
+            return run_ids[datafile]
+
         sql = "SELECT run_id FROM qc_run WHERE file_name = " + "'" + datafile + "'"
         try:
             self.cursor.execute(sql)
             run_id = self.cursor.fetchone()
+            run_ids[datafile] = run_id[0]
             return run_id[0]
         except Exception as e:
             print(e)
             return False
 
     def get_metric_id(self, name):
-        sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + name + "'"
-        try:
-            self.cursor.execute(sql)
-            metric_id = self.cursor.fetchone()
-            return metric_id[0]
-        except Exception as e:
-            print(e)
-            return False
+        return self.get_ids("metric").get(name, False)
 
     def get_component_id(self, name):
-        sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + name + "'"
-        try:
-            self.cursor.execute(sql)
-            comp_id = self.cursor.fetchone()
-            return comp_id[0]
-        except Exception as e:
-            print(e)
-            return False
+        return self.get_ids("component").get(name, False)
+
+    def get_machine_id(self, name):
+        return self.get_ids("machine").get(name, False)
+
+    def get_experiment_id(self, experiment_type):
+        return self.get_ids("experiment").get(experiment_type.lower(), False)
 
     def get_measurement(self, cid, mid, rid):
         sql = "SELECT m.metric_name, c.component_name, r.value, q.date_time FROM " \
@@ -0,0 +1,98 @@
+from MPMF_Json_File import load_json, save_json
+import os
+import time
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DirScanner:
+    """
+        Lists the raw files in the machine directories with os.scandir
+        The size and mtime come from the directory listing (no stat per file on windows),
+        machine directories are scanned at the same time and the listing is cached between runs
+        so a directory whose mtime hasn't changed isn't listed again
+        A directory is listed again while it holds a file changed within settle seconds of the last listing,
+        as a file being acquired changes size and mtime without changing the directory's mtime
+        Used by discovery in MPMF_Process_Raw_Files
+    """
+    def __init__(self, cache_file="", workers=8, settle=120):
+        self.cache_file = cache_file
+        self.workers = workers
+        self.settle = settle
+        # directory: {"mtime": directory mtime, "listed": time listed, "files": {name: [size, mtime]}}
+        self.cache = {}
+        # directory: files from the listing before the latest scan (None if never listed), see get_previous
+        self.previous = {}
+        self.load()
+
+    def load(self):
+        if self.cache_file != "":
+            self.cache = load_json(self.cache_file, {}, "scan cache")
+
+    def save(self):
+        if self.cache_file != "":
+            save_json(self.cache_file, self.cache)
+
+    def scan(self, raw_dirs):
+        # returns {machine: {raw file name: [size, mtime]}} for files matching each machine's pattern
+        machines = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(raw_dirs)))) as executor:
+            futures = {}
+            for machine in raw_dirs:
+                futures[machine] = executor.submit(self.scan_directory, raw_dirs[machine][0])
+            for machine in futures:
+                pattern = raw_dirs[machine][1]
+                files = futures[machine].result()
+                machines[machine] = {name: files[name] for name in files if fnmatch.fnmatch(name, pattern)}
+
+        self.save()
+        return machines
+
+    def scan_directory(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError as e:
+            print(e)
+            return {}
+
+        # nothing added or removed since the last scan and every file had settled when it was listed
+        entry = self.cache.get(directory)
+        self.previous[directory] = entry["files"] if entry is not None else None
+        if entry is not None and entry["mtime"] == mtime and self.is_settled(entry):
+            return entry["files"]
+
+        listed = time.time()
+        files = {}
+        try:
+            with os.scandir(directory) as entries:
+                for dir_entry in entries:
+                    if dir_entry.is_file():
+                        stat = dir_entry.stat()
+                        files[dir_entry.name] = [stat.st_size, stat.st_mtime]
+        except OSError as e:
+            print(e)
+            return {}
+
+        self.cache[directory] = {"mtime": mtime, "listed": listed, "files": files}
+        return files
+
+    def is_settled(self, entry):
+        # False if a file could still have been growing when the directory was listed
+        newest = max([entry["files"][name][1] for name in entry["files"]] or [0])
+        return newest < entry.get("listed", 0) - self.settle
+
+    def get_previous(self, directory):
+        # the directory's files {name: [size, mtime]} as listed before the latest scan, None if it is new
+        return self.previous.get(directory)
+
+    def get_paths(self, directory, files, oldest_first=False):
+        # raw file paths sorted by mtime, newest first unless oldest_first
+        names = sorted(files, key=lambda name: files[name][1], reverse=not oldest_first)
+        return [directory + "\\" + name for name in names]
+
+
+if __name__ == "__main__":
+    # TESTING
+    scanner = DirScanner("scan_cache_test.json")
+    raw_dirs = {"fusion": ["Z:\\qc_automation\\fusion\\instrument_data", "HelaiRT1ul_*.raw", "thermo"]}
+    print(scanner.scan(raw_dirs))
@@ -190,9 +190,7 @@ def check_email_thresholds_prot(filename):
             upper = thresholds[metric][2]
 
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "'"
-            db.cursor.execute(sql)
-            metric_id = db.cursor.fetchone()[0]
+            metric_id = db.get_metric_id(metric)
 
             # get values for metric and run_id
             sql = "SELECT c.component_name, v.value FROM " + \
@@ -317,10 +315,7 @@ def check_email_thresholds_prot(filename):
                         comps[metric] = [str(round(result[1], 3)) + " ppm"]
             elif metric == 'rt':
                 for result in results:
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + str(
-                        result[0]) + "'"
-                    db.cursor.execute(sql)
-                    comp_id = db.cursor.fetchone()[0]
+                    comp_id = db.get_component_id(str(result[0]))
 
                     # get all values per component
                     sql = "SELECT value FROM measurement WHERE metric_id = " + "'" + str(metric_id) + "'" + \
@@ -385,9 +380,7 @@ def check_email_thresholds_metab(filename):
             upper = thresholds[metric][2]
 
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "'"
-            db.cursor.execute(sql)
-            metric_id = db.cursor.fetchone()[0]
+            metric_id = db.get_metric_id(metric)
 
             # get values for metric and run_id (not limited by polarity)
             sql = "SELECT c.component_name, v.value FROM " + \
@@ -436,10 +429,7 @@ def check_email_thresholds_metab(filename):
                             breaches[metric + "_Pos"] = comps
             elif metric == 'rt':
                 for result in results:
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + str(
-                        result[0]) + "'"
-                    db.cursor.execute(sql)
-                    comp_id = db.cursor.fetchone()[0]
+                    comp_id = db.get_component_id(str(result[0]))
 
                     # get all values per component
                     sql = "SELECT value FROM measurement WHERE metric_id = " + "'" + str(metric_id) + "'" + \
@@ -470,10 +460,7 @@ def check_email_thresholds_metab(filename):
                     breaches[metric] = comps
             elif metric == 'area_normalised':
                 for result in results:
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + str(
-                        result[0]) + "'"
-                    db.cursor.execute(sql)
-                    comp_id = db.cursor.fetchone()[0]
+                    comp_id = db.get_component_id(str(result[0]))
 
                     # get all values per component
                     sql = "SELECT value FROM measurement WHERE metric_id = " + "'" + str(metric_id) + "'" + \
@@ -0,0 +1,84 @@
+from MPMF_Json_File import load_json, save_json
+import os
+import glob
+
+
+class FileIndex:
+    """
+        Persisted index of the raw files already seen in each machine directory
+        Discovery only lists the directory names and stats new arrivals,
+        so the cost scales with new files rather than all historic QC runs
+        Used by the watcher in MPMF_Process_Raw_Files
+    """
+    def __init__(self, index_file, max_attempts=3):
+        self.index_file = index_file
+        self.max_attempts = max_attempts # attempts before a failing file is marked as seen
+        self.index = {}
+        self.load()
+
+    def load(self):
+        self.index = load_json(self.index_file, {}, "file index")
+
+    def save(self):
+        save_json(self.index_file, self.index)
+
+    def get_directory(self, directory):
+        if directory not in self.index:
+            self.index[directory] = {"seen": {}, "attempts": {}}
+        return self.index[directory]
+
+    def new_files(self, directory, pattern, keep=1, files=None):
+        """Returns paths of unseen raw files in directory, newest first
+        files is {name: [size, mtime]} from a DirScanner, otherwise the directory is listed here"""
+        new_index = directory not in self.index
+        entry = self.get_directory(directory)
+
+        if files is not None:
+            new_paths = [(files[name][1], directory + '\\' + name) for name in files if name not in entry["seen"]]
+        else:
+            # listing only, no per file stat
+            names = [os.path.basename(path) for path in glob.glob(directory + '\\' + pattern)]
+            new_names = [name for name in names if name not in entry["seen"]]
+
+            # stat only the new arrivals
+            new_paths = []
+            for name in new_names:
+                path = directory + '\\' + name
+                try:
+                    new_paths.append((os.path.getmtime(path), path))
+                except OSError as e:
+                    print(e)
+        new_paths.sort(reverse=True)
+        new_paths = [path for mtime, path in new_paths]
+
+        # first time a directory is indexed only keep the newest files,
+        # the rest are history that has already been processed
+        if new_index:
+            for path in new_paths[keep:]:
+                entry["seen"][os.path.basename(path)] = "history"
+            new_paths = new_paths[:keep]
+
+        return new_paths
+
+    def mark_result(self, directory, raw_file, processed):
+        # processed files are seen, failures are retried until max_attempts
+        entry = self.get_directory(directory)
+        name = os.path.basename(raw_file)
+
+        if processed:
+            entry["seen"][name] = "processed"
+            entry["attempts"].pop(name, None)
+        else:
+            attempts = entry["attempts"].get(name, 0) + 1
+            if attempts >= self.max_attempts:
+                entry["seen"][name] = "failed"
+                entry["attempts"].pop(name, None)
+            else:
+                entry["attempts"][name] = attempts
+
+
+if __name__ == "__main__":
+    # TESTING
+    index = FileIndex("file_index_test.json")
+    print(index.new_files("Z:\\qc_automation\\fusion\\instrument_data", "HelaiRT1ul_*.raw"))
+    index.save()
@@ -0,0 +1,192 @@
+import os
+import socket
+import sqlite3
+import threading
+
+
+class JobQueue:
+    """
+        Shared queue of raw files in the job_queue table so several workers (processes or hosts) can process
+        a venue without processing a file twice
+        A worker claims a job with a lease (SELECT ... FOR UPDATE SKIP LOCKED on MySQL 8, BEGIN IMMEDIATE on SQLite),
+        keeps it with heartbeats while processing, and a job whose lease expires is claimed again by another worker
+        Works on a MySQL (mpmfdb, see MPMFDBSetUp.create_table_job_queue) or SQLite connection
+        Used by the --enqueue and --worker modes of MPMF_Process_Raw_Files
+    """
+    def __init__(self, connection, worker="", lease=900, max_attempts=3):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.worker = worker or socket.gethostname() + ":" + str(os.getpid())
+        self.lease = lease # seconds, renewed by heartbeats
+        self.max_attempts = max_attempts
+
+        # SQL that differs between MySQL and the SQLite stand-in
+        self.sqlite = isinstance(connection, sqlite3.Connection)
+        if self.sqlite:
+            self.param = "?"
+            self.now = "datetime('now')"
+            self.expires = "datetime('now', '+' || ? || ' seconds')"
+            self.insert = "INSERT OR IGNORE"
+        else:
+            self.param = "%s"
+            self.now = "NOW()"
+            self.expires = "DATE_ADD(NOW(), INTERVAL %s SECOND)"
+            self.insert = "INSERT IGNORE"
+
+    def create_table(self):
+        # SQLite stand-in only, the MySQL table is created with the other mpmfdb tables
+        sql = "CREATE TABLE IF NOT EXISTS job_queue (" \
+              "job_id INTEGER PRIMARY KEY AUTOINCREMENT," \
+              "file_name VARCHAR(255) NOT NULL UNIQUE," \
+              "raw_file VARCHAR(1024) NOT NULL," \
+              "machine VARCHAR(64) NOT NULL," \
+              "machine_type VARCHAR(32)," \
+              "experiment VARCHAR(32) NOT NULL," \
+              "venue VARCHAR(32) NOT NULL," \
+              "priority INTEGER NOT NULL DEFAULT 0," \
+              "status VARCHAR(16) NOT NULL DEFAULT 'queued'," \
+              "attempts INTEGER NOT NULL DEFAULT 0," \
+              "worker VARCHAR(128)," \
+              "lease_expires DATETIME," \
+              "heartbeat DATETIME," \
+              "queued_at DATETIME NOT NULL)"
+        self.cursor.execute(sql)
+        self.connection.commit()
+
+    def enqueue(self, file_name, raw_file, machine, machine_type, experiment, venue, priority=0, reset=False):
+        # a file already in the queue is left as it is, or with reset queued again if it is done or failed
+        # returns True if added
+        sql = self.insert + " INTO job_queue (file_name, raw_file, machine, machine_type, experiment, venue, " \
+              "priority, queued_at) VALUES (" + ",".join([self.param] * 7) + "," + self.now + ")"
+        try:
+            self.cursor.execute(sql, (file_name, raw_file, machine, machine_type, experiment, venue, priority))
+            added = self.cursor.rowcount > 0
+            if not added and reset:
+                sql = "UPDATE job_queue SET status = 'queued', attempts = 0, worker = NULL, lease_expires = NULL, " \
+                      "raw_file = " + self.param + ", priority = " + self.param + ", queued_at = " + self.now + \
+                      " WHERE file_name = " + self.param + " AND status IN ('done', 'failed')"
+                self.cursor.execute(sql, (raw_file, priority, file_name))
+                added = self.cursor.rowcount > 0
+            self.connection.commit()
+            return added
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+            return False
+
+    def claim(self, experiment, venue):
+        # returns (job_id, raw_file, machine, machine_type) for the next queued (or expired) job, or None
+        # an expired job that has had max_attempts is failed rather than claimed again
+        expired = "experiment = " + self.param + " AND venue = " + self.param + " AND status = 'running' AND " \
+                  "lease_expires < " + self.now
+        failed = "UPDATE job_queue SET status = 'failed', lease_expires = NULL WHERE " + expired + \
+                 " AND attempts >= " + self.param
+        where = "experiment = " + self.param + " AND venue = " + self.param + " AND (status = 'queued' OR " \
+                "(status = 'running' AND lease_expires < " + self.now + " AND attempts < " + self.param + "))"
+        sql = "SELECT job_id, raw_file, machine, machine_type FROM job_queue WHERE " + where + \
+              " ORDER BY priority DESC, job_id LIMIT 1"
+
+        try:
+            if self.sqlite:
+                # takes the write lock, so claims are serialised
+                self.cursor.execute("BEGIN IMMEDIATE")
+            else:
+                # other workers skip the locked row rather than waiting for it
+                self.connection.begin()
+                sql += " FOR UPDATE SKIP LOCKED"
+
+            self.cursor.execute(failed, (experiment, venue, self.max_attempts))
+            self.cursor.execute(sql, (experiment, venue, self.max_attempts))
+            row = self.cursor.fetchone()
+            if row is None:
+                self.connection.commit()
+                return None
+
+            sql = "UPDATE job_queue SET status = 'running', attempts = attempts + 1, worker = " + self.param + \
+                  ", lease_expires = " + self.expires + ", heartbeat = " + self.now + " WHERE job_id = " + self.param
+            self.cursor.execute(sql, (self.worker, self.lease, row[0]))
+            self.connection.commit()
+            return row
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+            return None
+
+    def heartbeat(self, job_id):
+        # extend the lease, False if the job has been taken by another worker
+        sql = "UPDATE job_queue SET lease_expires = " + self.expires + ", heartbeat = " + self.now + \
+              " WHERE job_id = " + self.param + " AND worker = " + self.param + " AND status = 'running'"
+        try:
+            self.cursor.execute(sql, (self.lease, job_id, self.worker))
+            self.connection.commit()
+            return self.cursor.rowcount > 0
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+            return False
+
+    def complete(self, job_id, processed):
+        # done, or queued again until max_attempts then failed
+        sql = "UPDATE job_queue SET status = CASE WHEN " + self.param + " THEN 'done' " \
+              "WHEN attempts < " + self.param + " THEN 'queued' ELSE 'failed' END, lease_expires = NULL " \
+              "WHERE job_id = " + self.param + " AND worker = " + self.param
+        try:
+            self.cursor.execute(sql, (1 if processed else 0, self.max_attempts, job_id, self.worker))
+            self.connection.commit()
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+
+    def requeue(self, job_id):
+        # give a claimed job back, eg. when the worker is stopped
+        sql = "UPDATE job_queue SET status = 'queued', attempts = attempts - 1, lease_expires = NULL " \
+              "WHERE job_id = " + self.param + " AND worker = " + self.param
+        try:
+            self.cursor.execute(sql, (job_id, self.worker))
+            self.connection.commit()
+        except Exception as e:
+            print(e)
+            self.connection.rollback()
+
+
+class JobHeartbeat(threading.Thread):
+    """
+        Renews a claimed job's lease every third of the lease until stopped
+        Uses its own connection (from connect) as connections aren't shared between threads
+    """
+    def __init__(self, job_id, connect, worker, lease):
+        threading.Thread.__init__(self, name="heartbeat-" + str(job_id))
+        self.daemon = True
+        self.job_id = job_id
+        self.connect = connect
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def run(self):
+        connection = self.connect()
+        queue = JobQueue(connection, self.worker, self.lease)
+        try:
+            while not self.stopped.wait(self.lease / 3):
+                if not queue.heartbeat(self.job_id):
+                    print("Lost lease on job " + str(self.job_id))
+                    break
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+if __name__ == "__main__":
+    # TESTING (SQLite stand-in)
+    db_file = "job_queue_test.db"
+    queue = JobQueue(sqlite3.connect(db_file, isolation_level=None), "worker-a", lease=2)
+    queue.create_table()
+    queue.enqueue("HelaiRT1ul_190722200502", "Z:\\HelaiRT1ul_190722200502.raw", "fusion", "thermo",
+                  "PROTEOMICS", "CLAYTON")
+    job = queue.claim("PROTEOMICS", "CLAYTON")
+    print(job)
+    print(JobQueue(sqlite3.connect(db_file, isolation_level=None), "worker-b").claim("PROTEOMICS", "CLAYTON"))
+    queue.complete(job[0], True)
@@ -0,0 +1,30 @@
+import os
+import json
+
+
+# small json files kept between runs (file index, scan cache, scratch manifest)
+def load_json(path, default, name="file"):
+    # default if the file isn't there yet or can't be read
+    if os.path.isfile(path):
+        try:
+            with open(path, 'r') as infile:
+                return json.load(infile)
+        except Exception as e:
+            print(e)
+            print("Could not read " + name + ", starting a new one")
+    return default
+
+
+def save_json(path, data):
+    # write to temp file then replace so a crash can't leave a half written file
+    # (temp file per process as several processes can save the same file)
+    temp_file = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_file, 'w') as outfile:
+        json.dump(data, outfile)
+    os.replace(temp_file, path)
+
+
+if __name__ == "__main__":
+    # TESTING
+    save_json("json_file_test.json", {"test": [1, 2]})
+    print(load_json("json_file_test.json", {}))
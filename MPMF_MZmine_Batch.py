@@ -0,0 +1,135 @@
+import os
+import time
+import shutil
+import zipfile # mzmine project files are zip files
+import xml.etree.ElementTree as et
+from MPMF_Tool_Runner import ToolRunner
+
+
+class MZmineBatch:
+    """
+        Runs MZmine once for a batch of raw files instead of once per file
+        Combines the batch steps of each file's xml (from metab_template.xml / proteo_template.xml),
+        so each file's csv export still goes to its own outfiles folder, and saves one project
+        that is then split into a .mzmine project per file for Chromatogram
+        Used by process_batches in MPMF_Process_Raw_Files
+    """
+    PROJECT_SAVE = "net.sf.mzmine.modules.projectmethods.projectsave.ProjectSaveModule"
+
+    def __init__(self, filesystem, experiment):
+        self.fs = filesystem
+        self.experiment = experiment.upper()
+        self.batch_dir = self.fs.out_dir + "\\" + self.experiment + "\\" + "mzmine_batch" + "\\" \
+                         + time.strftime("%Y%m%d%H%M%S")
+        self.batch_xml = self.batch_dir + "\\" + "batch.xml"
+        self.batch_project = self.batch_dir + "\\" + "batch.mzmine"
+        self.qc_runs = []
+
+    def add(self, qc_run):
+        # qc_run is a ProcessRawFile that has completed its xml stage
+        self.qc_runs.append(qc_run)
+
+    def run(self):
+        # returns {file name: True if its csv output and project were created}
+        results = {}
+        if len(self.qc_runs) == 0:
+            return results
+
+        if not os.path.isdir(self.batch_dir):
+            os.makedirs(self.batch_dir)
+
+        self.create_batch_xml()
+        started = time.time()
+        command = 'startMZmine_Windows.bat ' + '"' + self.batch_xml + '"'
+        runner = ToolRunner("mzmine", self.qc_runs[0].settings, self.batch_dir + "\\" + "mzmine.log",
+                            len(self.qc_runs))
+        if not runner.run(command, self.fs.sw_dir + "\\" + "MZmine-2.32"):
+            print("mzMine: batch processing error " + self.batch_xml)
+
+        # mzmine can stop part way through, check each file's outputs rather than the return value
+        projects = self.split_project()
+        for qc_run in self.qc_runs:
+            results[qc_run.file_name] = qc_run.file_name in projects and self.has_csv(qc_run, started)
+
+        self.clean_up()
+        return results
+
+    def clean_up(self):
+        # the batch log goes to each file's mzmine.log, then the combined xml and project are removed
+        try:
+            with open(self.batch_dir + "\\" + "mzmine.log", 'r') as infile:
+                log = infile.read()
+            for qc_run in self.qc_runs:
+                with open(qc_run.outfiles_dir + "\\" + "mzmine.log", 'a') as outfile:
+                    outfile.write(log)
+        except Exception as e:
+            print(e)
+        shutil.rmtree(self.batch_dir, ignore_errors=True)
+
+    def create_batch_xml(self):
+        # every file's steps in order, then a single project save at the end
+        batch = et.Element("batch")
+        for qc_run in self.qc_runs:
+            tree = et.parse(qc_run.outfiles_dir + "\\" + qc_run.file_name + ".xml")
+            for step in tree.getroot().findall("batchstep"):
+                if step.get("method") != self.PROJECT_SAVE:
+                    batch.append(step)
+
+        save = et.SubElement(batch, "batchstep", method=self.PROJECT_SAVE)
+        et.SubElement(save, "parameter", name="Project file").text = self.batch_project
+
+        et.ElementTree(batch).write(self.batch_xml, encoding="UTF-8", xml_declaration=True)
+
+    def has_csv(self, qc_run, started):
+        outputs = ["posoutput.csv"]
+        if self.experiment == "METABOLOMICS":
+            outputs.append("negoutput.csv")
+
+        for output in outputs:
+            path = qc_run.outfiles_dir + "\\" + output
+            if not os.path.isfile(path) or os.path.getmtime(path) < started:
+                return False
+        return True
+
+    def split_project(self):
+        # writes <file>.mzmine into each outfiles folder with only that file's raw data and peak lists
+        # returns the file names that were written
+        written = []
+        if not os.path.isfile(self.batch_project):
+            print("mzMine: no batch project " + self.batch_project)
+            return written
+
+        with zipfile.ZipFile(self.batch_project, "r") as project:
+            namelist = project.namelist()
+
+            # raw data file id -> raw file name (eg. <file>_pos.mzXML)
+            raw_names = {}
+            for name in namelist:
+                if name.startswith("Raw data file #") and name.endswith(".xml"):
+                    raw_id = name[len("Raw data file #"):].split(" ")[0]
+                    root = et.fromstring(project.read(name))
+                    raw_names[raw_id] = root.find("name").text
+
+            # peak list -> raw data file id
+            peak_lists = {}
+            for name in namelist:
+                if name.startswith("Peak list #") and name.endswith(".xml"):
+                    root = et.fromstring(project.read(name))
+                    peak_lists[name] = root.find("raw_file").text
+
+            for qc_run in self.qc_runs:
+                raw_ids = [raw_id for raw_id in raw_names if raw_names[raw_id].startswith(qc_run.file_name + "_")]
+                if len(raw_ids) == 0:
+                    continue
+
+                entries = [name for name in namelist if name.startswith("Raw data file #")
+                           and name[len("Raw data file #"):].split(" ")[0] in raw_ids]
+                entries += [name for name in peak_lists if peak_lists[name] in raw_ids]
+
+                project_file = qc_run.outfiles_dir + "\\" + qc_run.file_name + ".mzmine"
+                with zipfile.ZipFile(project_file, "w", zipfile.ZIP_DEFLATED) as outfile:
+                    for name in entries:
+                        outfile.writestr(name, project.read(name))
+                written.append(qc_run.file_name)
+
+        return written
@@ -0,0 +1,91 @@
+import os
+import shutil
+import time
+from MPMF_Tool_Runner import ToolRunner
+
+
+class MorpheusBatch:
+    """
+        Runs Morpheus once for a batch of proteomics raw files instead of once per file
+        so HUMAN.fasta is read and digested once per batch
+        Each file's summary.tsv row and <file>.PSMs.tsv are copied back to its own Morpheus folder,
+        where insert_morpheus reads them as if Morpheus had been run for the file alone
+        Used by process_batch in MPMF_Process_Raw_Files
+    """
+    def __init__(self, filesystem, experiment):
+        self.fs = filesystem
+        self.batch_dir = filesystem.out_dir + "\\" + experiment.upper() + "\\" + "morpheus_batch" + "\\" \
+                         + time.strftime("%Y%m%d%H%M%S")
+        self.qc_runs = []
+
+    def add(self, qc_run):
+        self.qc_runs.append(qc_run)
+
+    def run(self):
+        # returns {file name: True if its summary row and PSMs were found}
+        results = {}
+        if len(self.qc_runs) == 0:
+            return results
+
+        if not os.path.isdir(self.batch_dir):
+            os.makedirs(self.batch_dir)
+
+        data = ",".join([qc_run.raw_file for qc_run in self.qc_runs])
+        command = self.qc_runs[0].morpheus_command(data, self.batch_dir)
+        runner = ToolRunner("morpheus", self.qc_runs[0].settings, self.batch_dir + "\\" + "morpheus.log",
+                            len(self.qc_runs))
+        if not runner.run(command, self.qc_runs[0].morpheus_dir()):
+            print("Morpheus: batch processing error " + self.batch_dir)
+
+        # morpheus writes what it can, check each file rather than the return value
+        summary = self.read_summary()
+        for qc_run in self.qc_runs:
+            results[qc_run.file_name] = self.route(qc_run, summary)
+
+        self.clean_up()
+        return results
+
+    def clean_up(self):
+        # the batch log goes to each file's morpheus.log, then the batch outputs are removed
+        try:
+            with open(self.batch_dir + "\\" + "morpheus.log", 'r') as infile:
+                log = infile.read()
+            for qc_run in self.qc_runs:
+                with open(qc_run.outfiles_dir + "\\" + "morpheus.log", 'a') as outfile:
+                    outfile.write(log)
+        except Exception as e:
+            print(e)
+        shutil.rmtree(self.batch_dir, ignore_errors=True)
+
+    def read_summary(self):
+        # returns header line and {dataset file name: summary line}
+        summary_file = self.batch_dir + "\\" + "summary.tsv"
+        if not os.path.isfile(summary_file):
+            return None, {}
+
+        with open(summary_file, 'r') as infile:
+            lines = infile.readlines()
+
+        rows = {}
+        for line in lines[1:]:
+            dataset = line.split("\t")[0].strip()
+            # dataset is the raw file (with or without path), the aggregate row doesn't match a file
+            rows[os.path.splitext(dataset.split("\\")[-1])[0]] = line
+
+        return lines[0], rows
+
+    def route(self, qc_run, summary):
+        header, rows = summary
+        psms = self.batch_dir + "\\" + qc_run.file_name + ".PSMs.tsv"
+        if qc_run.file_name not in rows or not os.path.isfile(psms):
+            return False
+
+        if not os.path.isdir(qc_run.morph_out_dir):
+            os.makedirs(qc_run.morph_out_dir)
+
+        with open(qc_run.morph_out_dir + "\\" + "summary.tsv", 'w') as outfile:
+            outfile.write(header)
+            outfile.write(rows[qc_run.file_name])
+        shutil.copyfile(psms, qc_run.morph_out_dir + "\\" + qc_run.file_name + ".PSMs.tsv")
+
+        return True
@@ -0,0 +1,106 @@
+import re
+
+
+class MzXMLSplit:
+    """
+        Splits a polarity switching mzXML file (from one msconvert run) into positive and negative files
+        so the raw file is only decoded once for metabolomics
+        Reads the file line by line as written by msconvert, scans are copied by their polarity attribute
+        and the index (optional in mzXML) is left out as its offsets no longer apply
+        Used by ProcessRawFile.run_msconvert
+    """
+    SCAN_OPEN = re.compile(r'<scan[\s>]')
+    POLARITY = re.compile(r'polarity="([+-])"')
+
+    def __init__(self, mzxml_file):
+        self.mzxml_file = mzxml_file
+
+    def split(self, pos_file, neg_file):
+        # returns True if both files were written
+        counts = self.count_scans()
+        if counts["+"] == 0 or counts["-"] == 0:
+            print("Polarity split: missing polarity in " + self.mzxml_file)
+            return False
+
+        with open(self.mzxml_file, 'r') as infile, open(pos_file, 'w') as pos, open(neg_file, 'w') as neg:
+            outfiles = {"+": pos, "-": neg}
+            for kind, lines in self.read_blocks(infile):
+                if kind == "scan":
+                    polarity = self.get_polarity(lines)
+                    if polarity in outfiles:
+                        outfiles[polarity].writelines(lines)
+                elif kind == "header":
+                    # msRun scanCount for each file
+                    for line in lines:
+                        pos.write(re.sub(r'scanCount="\d+"', 'scanCount="' + str(counts["+"]) + '"', line))
+                        neg.write(re.sub(r'scanCount="\d+"', 'scanCount="' + str(counts["-"]) + '"', line))
+                else:
+                    pos.writelines(lines)
+                    neg.writelines(lines)
+
+        return True
+
+    def count_scans(self):
+        counts = {"+": 0, "-": 0}
+        with open(self.mzxml_file, 'r') as infile:
+            for kind, lines in self.read_blocks(infile):
+                if kind == "scan":
+                    polarity = self.get_polarity(lines)
+                    if polarity in counts:
+                        counts[polarity] += 1
+        return counts
+
+    def read_blocks(self, infile):
+        # yields ("header", lines), ("scan", lines) for each top level scan (nested scans included)
+        # and ("footer", lines) without the index, offset and checksum
+        header = []
+        scan = []
+        depth = 0
+        in_index = False
+        for line in infile:
+            opened = len(self.SCAN_OPEN.findall(line))
+            if depth == 0 and opened == 0:
+                # before the first scan is header, after the last is footer
+                if header is not None:
+                    header.append(line)
+                    continue
+
+                stripped = line.strip()
+                if stripped.startswith("<index ") or stripped.startswith("<index>"):
+                    in_index = "</index>" not in stripped
+                    continue
+                if in_index:
+                    in_index = "</index>" not in stripped
+                    continue
+                if stripped.startswith("<indexOffset") or stripped.startswith("<sha1"):
+                    continue
+                yield "footer", [line]
+                continue
+
+            if header is not None:
+                yield "header", header
+                header = None
+
+            scan.append(line)
+            depth += opened - line.count("</scan>")
+            if depth <= 0:
+                yield "scan", scan
+                scan = []
+                depth = 0
+
+        if header is not None:
+            yield "header", header
+
+    def get_polarity(self, lines):
+        # attributes come before nested scans so the first polarity is the top level scan's
+        for line in lines:
+            match = self.POLARITY.search(line)
+            if match is not None:
+                return match.group(1)
+        return None
+
+
+if __name__ == "__main__":
+    # TESTING
+    mzxml = "C:\\QC_Work\\METABOLOMICS\\qeclassic\\QC_Metabolomics_20190722_01\\QC_Metabolomics_20190722_01_all.mzXML"
+    MzXMLSplit(mzxml).split(mzxml.replace("_all", "_pos"), mzxml.replace("_all", "_neg"))
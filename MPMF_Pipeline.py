@@ -0,0 +1,100 @@
+import threading
+import queue
+
+
+class Pipeline:
+    """
+        Bounded multi-stage pipeline for processing several raw files at once
+        eg. file N+1 in msconvert while file N is in MZmine and file N-1 is being inserted
+        Each stage has a worker limit and a bounded input queue, so a slow stage
+        blocks the stage before it (backpressure) rather than letting work pile up
+        Stages are (name, function, workers), function(item) returns True to pass the item on
+        Used by process_pipeline in MPMF_Process_Raw_Files
+    """
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for stage in self.stages]
+        self.done = queue.Queue()
+        self.threads = []
+        self.interrupt = None # KeyboardInterrupt from a stage, raised by run
+        self.stopped = False
+
+    def run(self, items):
+        # generator, yields (item, completed) as each item finishes or drops out
+        if len(items) == 0:
+            return
+
+        for index in range(len(self.stages)):
+            name, function, workers = self.stages[index]
+            for i in range(workers):
+                thread = threading.Thread(target=self.work, args=(index,), name=name + "-" + str(i))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        # feed from a thread so a full first queue blocks the feeder not the caller
+        feeder = threading.Thread(target=self.feed, args=(items,), name="feeder")
+        feeder.daemon = True
+        feeder.start()
+
+        try:
+            for i in range(len(items)):
+                result = self.done.get()
+                if self.interrupt is not None:
+                    raise self.interrupt
+                yield result
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+
+        # every item has finished so the queues are empty, stop the workers
+        feeder.join()
+        for index in range(len(self.stages)):
+            for i in range(self.stages[index][2]):
+                self.queues[index].put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stop(self):
+        # items still queued drop out and nothing new starts, stages finish the item they are on
+        self.stopped = True
+        for index in range(len(self.stages)):
+            for i in range(self.stages[index][2]):
+                try:
+                    self.queues[index].put_nowait(None)
+                except queue.Full:
+                    pass # the worker drops the queued items then gets the next None
+
+    def feed(self, items):
+        for item in items:
+            if self.stopped:
+                break
+            self.queues[0].put(item)
+
+    def work(self, index):
+        name, function, workers = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                break
+
+            passed = False
+            if not self.stopped:
+                try:
+                    passed = function(item)
+                except SystemExit:
+                    # eg. Chromatogram exits if the .mzmine file is missing
+                    print("Pipeline stage " + name + " exited")
+                except KeyboardInterrupt as e:
+                    # raised by run once the stages are stopped
+                    self.interrupt = e
+                except Exception as e:
+                    print(e)
+                    print("Pipeline stage " + name + " error")
+
+            # the item is always passed on or finished, so run doesn't wait for it forever
+            if passed and not self.stopped and index + 1 < len(self.stages):
+                self.queues[index + 1].put(item) # blocks while the next stage is full
+            else:
+                self.done.put((item, bool(passed)))
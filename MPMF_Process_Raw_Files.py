@@ -4,15 +4,32 @@ from MPMF_Stats import Stat
 from MPMF_Chromatogram import Chromatogram
 from MPMF_Email import SendEmail
 from MPMF_Thermo_Metrics import ThermoMetrics
+from MPMF_File_Index import FileIndex
+from MPMF_Stage_Ledger import StageLedger
+from MPMF_Stage_Executor import StageExecutor
+from MPMF_Pipeline import Pipeline
+from MPMF_MZmine_Batch import MZmineBatch
+from MPMF_Morpheus_Batch import MorpheusBatch
+from MPMF_Scratch_Cache import ScratchCache, file_md5
+from MPMF_MzXML_Split import MzXMLSplit
+from MPMF_Tool_Runner import ToolRunner
+from MPMF_Artifact_Cache import ArtifactCache
+from MPMF_Dir_Scanner import DirScanner
+from MPMF_Job_Queue import JobQueue, JobHeartbeat
+from MPMF_Resource_Governor import ResourceGovernor
 import os
 import glob
-import sys
-from decimal import getcontext, Decimal
 import subprocess
 import json
 import multiprocessing as mp
+import argparse
+import pandas as pd
+import copy
+import shutil
+import threading
+import time
+import datetime
 
-getcontext().prec = 12
 
 # NOT RUNNING MORPHEUS
 
@@ -22,95 +39,334 @@ class ProcessRawFile:
         Inserts metric data into database
         Uses SendEmail and Stat
     """
-    def __init__(self, file_name, file_path, machine, e_type, filesystem, db_info, venue):
+    # MZmine csv export columns after the row identity (see the xml templates), metric names in mzmine_metrics.txt
+    MZMINE_COLUMNS = ["mz", "rt", "height", "area", "fwhm", "tf", "af", "mz_min", "mz_max"]
+    # computed from the csv columns by read_mzmine_csv
+    DERIVED_COLUMNS = ["mass_error_ppm", "mass_error_dalton"]
+
+    def __init__(self, file_name, file_path, machine, e_type, filesystem, db_info, venue, morpheus_threads=0,
+                 settings=None, machine_type=""):
 
         self.experiment = e_type.upper()
         self.machine = machine
+        self.machine_type = machine_type
         self.venue = venue
         self.file_name = file_name
         self.fs = filesystem
+        # skip: optional steps turned off (eg. no emails when backfilling history)
+        # scratch, scratch_size: local cache for the raw file (see ScratchCache)
+        # work_dir, publish: local outfiles root and the outputs copied to out_dir at the end (see publish)
+        # artifact_cache: directory of mzmine and morpheus outputs to reuse (see ArtifactCache)
+        self.settings = settings or {}
+        self.send_email = "email" not in self.settings.get("skip", [])
+        self.publish_dir = self.fs.out_dir + "\\" + self.experiment + "\\" + self.machine + "\\" + self.file_name
+        if self.settings.get("work_dir"):
+            # intermediates (mzXML, mzmine project, chromatogram files) stay on local disk
+            self.fs = copy.copy(filesystem)
+            self.fs.out_dir = self.settings["work_dir"]
         self.db = MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], self.fs)
         self.raw_file = file_path
         self.metadata = {'filename': self.file_name, 'experiment': self.experiment, 'machine': self.machine, 'loc': self.venue}
         self.outfiles_dir = self.fs.out_dir + "\\" + self.experiment + "\\" + self.machine + "\\" + self.file_name
         self.morph_out_dir = self.outfiles_dir + "\\" + "Morpheus"
 
-        # make and set folder for outfiles
-        os.chdir(self.fs.out_dir)
+        # morpheus runs alongside msconvert/mzmine so give it half the cores (-mt) unless set,
+        # or the cores it is admitted with by the ResourceGovernor
+        self.morpheus_threads = morpheus_threads
+        if self.morpheus_threads <= 0 and self.settings.get("governor") is not None:
+            self.morpheus_threads = self.settings["governor"].footprints["morpheus"][1]
+        if self.morpheus_threads <= 0:
+            self.morpheus_threads = max(1, (os.cpu_count() or 2) // 2)
+        self.morpheus_thread = None
+        self.morpheus_result = False
+        self.early_morpheus = True
+        self.raw_hash = None
+        self.email_data = None
+
+        # make folder for outfiles (no chdir, tools are given a working directory instead)
         if not os.path.isdir(self.outfiles_dir):
-            os.makedirs(self.experiment + "\\" + self.machine + "\\" + self.file_name)
+            os.makedirs(self.outfiles_dir)
 
 
     # RUN
-    def run(self):
-        # check if a QC file and not inserted
-        check_run = False
-        if self.check_file_name():
-            if not self.check_run():
-                # convert raw file
-                if self.run_msconvert():
-                    # create xml
-                    if self.experiment == "METABOLOMICS":
-                        self.create_metab_xml()
-                    elif self.experiment == "PROTEOMICS":
-                        self.create_proteo_xml()
-                    if self.run_mzmine():
-                        if self.insert_qc_run_data():
-                            if self.experiment == "METABOLOMICS":
-                                self.insert_pos_csv()
-                                self.insert_neg_csv()
-                                self.fwhm_to_seconds()
-                                email_data = self.check_email_thresholds_metab()
-                                self.insert_summary(email_data)
-                                if len(email_data) > 0:
-                                    email_data['metadata'] = self.metadata
-                                    SendEmail(email_data, self.db, self.fs)
-                                else:
-                                    print("No Email Sent")
-                            elif self.experiment == "PROTEOMICS":
-                                self.insert_pos_csv()
-                                self.fwhm_to_seconds()
-                                if self.run_morpheus(): #FALSE
-                                    self.insert_morpheus()
-                                    email_data = self.check_email_thresholds_prot()
-                                    self.insert_summary(email_data)
-                                    if len(email_data) > 0:
-                                        email_data['metadata'] = self.metadata
-                                        SendEmail(email_data, self.db, self.fs)
-                                    else:
-                                        print("No Email Sent")
-                                else:
-                                    print("Morpheus error " + self.file_name)
-                            print("Inserted Data for " + self.machine + " " + self.file_name)
-                            #self.delete_files()
-                            check_run = True
-                        else:
-                            print("Insert run details error " + self.file_name)
-                    else:
-                        print("mzMine: processing error " + self.file_name)
-                else:
-                    print("msconvert: file too small or still writing  " + self.file_name)
-            else:
-                print("Already Inserted " + self.file_name)
-        else:
+    # start, convert, process_mzmine, complete_morpheus then ingest (see ingest_run), split so MPMF_Pipeline
+    # can overlap files, stages already completed for the file are skipped (see StageLedger)
+    def start(self, early_morpheus=True):
+        # accept the file and set the resume point, early_morpheus starts morpheus for proteomics once
+        # msconvert has accepted the file (batch mode leaves morpheus to be run at the morpheus stage)
+        if not self.check_file_name():
             print("Incorrect file format " + self.file_name)
+            return False
 
-        os.chdir(self.fs.main_dir)
-        return check_run
+        # one process per raw file, released when the connection is closed
+        if not self.db.get_lock("mpmf_run_" + self.file_name, 0):
+            print("Being processed by another process " + self.file_name)
+            return False
 
-    def run_mzmine(self):
-        os.chdir(self.fs.sw_dir + "\\" + "MZmine-2.32")
-        command = 'startMZmine_Windows.bat ' + '"' + self.outfiles_dir + "\\"+ self.file_name + '.xml' + '"'
-        returnvalue = os.system(command)
-        if returnvalue:
+        self.ledger = StageLedger(self.file_name, self.db)
+        self.stages = self.get_stages()
+        self.resume_stage = self.get_resume_stage()
+        if self.resume_stage != self.stages[0]:
+            print("Resuming " + self.file_name + " at " + self.resume_stage)
+        # forget the resume stage and everything after it so they run again
+        self.ledger.clear(self.stages[self.stages.index(self.resume_stage):])
+
+        if self.check_run():
+            print("Already Inserted " + self.file_name)
+            return False
+
+        # read the raw file from local disk rather than the share
+        if self.settings.get("scratch") and self.needs_raw_file():
+            self.fetch_raw_file()
+
+        self.restore_cached_stages()
+        self.early_morpheus = early_morpheus
+        return True
+
+    def convert(self):
+        # convert raw file and create xml
+        if not self.run_stage("msconvert", self.run_msconvert):
+            print("msconvert: file too small or still writing  " + self.file_name)
+            return False
+
+        # morpheus only needs the raw file, run it alongside mzmine
+        # (not before msconvert accepts the file, a rejected file would leave it running)
+        if self.early_morpheus and "morpheus" in self.stages and self.needs_stage("morpheus") \
+                and not self.restore_artifacts("morpheus"):
+            self.start_morpheus()
+
+        self.run_stage("xml", self.create_xml)
+        return True
+
+    def process_mzmine(self, mzmine=None):
+        # mzmine is called instead of run_mzmine when the file was processed in an MZmineBatch
+        if mzmine is None:
+            mzmine = self.run_mzmine
+        if not self.run_stage("mzmine", self.cached("mzmine", mzmine)):
+            print("mzMine: processing error " + self.file_name)
+            return False
+        return True
+
+    def complete_morpheus(self, morpheus=None):
+        # wait for (or run) morpheus before the inserts, so the run's transaction isn't held open while it runs
+        # morpheus is called instead of join_morpheus when the file was processed in a MorpheusBatch
+        # returns False if morpheus failed, the run is still inserted without its metrics
+        if "morpheus" not in self.stages:
+            return True
+        if morpheus is None:
+            morpheus = self.join_morpheus
+        if not self.run_stage("morpheus", self.cached("morpheus", morpheus)):
+            print("Morpheus error " + self.file_name)
+            return False
+        return True
+
+    def ingest(self, morpheus_done=True):
+        # insert run and metrics, check thresholds
+        # called inside the run's unit of work (see ingest_run), False rolls all of it back
+        if not self.run_stage("qc_run", self.insert_qc_run_data):
+            print("Insert run details error " + self.file_name)
+            return False
+
+        if not self.run_stage("csv", self.insert_csv):
+            print("Insert csv error " + self.file_name)
+            return False
+
+        if self.experiment == "METABOLOMICS":
+            self.run_stage("summary", self.check_thresholds_and_email)
+        elif self.experiment == "PROTEOMICS" and morpheus_done:
+            self.run_stage("morpheus_insert", self.insert_morpheus)
+            self.run_stage("summary", self.check_thresholds_and_email)
+        print("Inserted Data for " + self.machine + " " + self.file_name)
+        #self.delete_files()
+        return True
+
+    def publish(self):
+        # copy the final outputs from the local work folder to out_dir, then remove the work folder
+        if not self.settings.get("work_dir"):
+            return True
+
+        try:
+            for pattern in self.settings["publish"]:
+                for path in glob.glob(self.outfiles_dir + "\\" + pattern):
+                    target = self.publish_dir + path[len(self.outfiles_dir):]
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    shutil.copyfile(path, target)
+        except Exception as e:
+            print(e)
+            print("Publish error, outputs left in " + self.outfiles_dir)
+            return False
+
+        shutil.rmtree(self.outfiles_dir, ignore_errors=True)
+        return True
+
+    def finish(self):
+        # don't leave morpheus running if an earlier stage failed
+        if self.morpheus_thread is not None:
+            self.morpheus_thread.join()
+            self.morpheus_thread = None
+
+    # STAGES
+    def get_stages(self):
+        # processing stages in order, morpheus for proteomics only
+        # tool stages before the inserts, which are committed together (see ingest_run)
+        if self.experiment == "PROTEOMICS":
+            return ["msconvert", "xml", "mzmine", "morpheus", "qc_run", "csv", "morpheus_insert", "summary"]
+        return ["msconvert", "xml", "mzmine", "qc_run", "csv", "summary"]
+
+    def get_resume_stage(self):
+        # first stage not completed (or whose output has gone), start again if all completed
+        for stage in self.stages:
+            if not (self.ledger.is_done(stage) and self.has_output(stage)):
+                return stage
+        return self.stages[0]
+
+    def has_output(self, stage):
+        # the files (or rows) a completed stage left behind for later stages
+        outputs = []
+        if stage == "msconvert":
+            outputs.append(self.outfiles_dir + "\\" + self.file_name + "_pos.mzXML")
+            if self.experiment == "METABOLOMICS":
+                outputs.append(self.outfiles_dir + "\\" + self.file_name + "_neg.mzXML")
+        elif stage == "xml":
+            outputs.append(self.outfiles_dir + "\\" + self.file_name + ".xml")
+        elif stage == "mzmine":
+            outputs.append(self.outfiles_dir + "\\" + self.file_name + ".mzmine")
+            outputs.append(self.outfiles_dir + "\\" + "posoutput.csv")
+            if self.experiment == "METABOLOMICS":
+                outputs.append(self.outfiles_dir + "\\" + "negoutput.csv")
+        elif stage == "morpheus":
+            outputs.append(self.morph_out_dir + "\\" + "summary.tsv")
+            outputs.append(self.morph_out_dir + "\\" + self.file_name + ".PSMs.tsv")
+        elif stage == "qc_run":
+            return bool(self.db.get_run_id(self.file_name))
+
+        for output in outputs:
+            if not os.path.isfile(output):
+                return False
+        return True
+
+    def needs_raw_file(self):
+        # msconvert, morpheus and thermo metrics (after ingest, thermo machines only) read the raw file
+        return self.needs_stage("msconvert") or "morpheus" in self.stages and self.needs_stage("morpheus") \
+               or self.machine_type == "thermo" and "thermo" not in self.settings.get("skip", [])
+
+    def fetch_raw_file(self):
+        try:
+            cache = ScratchCache(self.settings["scratch"], self.settings["scratch_size"])
+            self.raw_file = cache.fetch(self.raw_file)
+            # md5 of the copy for the artifact key, saves reading the raw file again
+            self.raw_hash = cache.manifest[os.path.basename(self.raw_file)]["md5"] or None
+        except Exception as e:
+            print(e)
+            print("Scratch copy failed, using share " + self.file_name)
+
+    # ARTIFACTS
+    def cached(self, tool, function):
+        # wraps a tool stage so cached outputs are restored instead of running it, and new outputs are cached
+        def run_cached():
+            if self.restore_artifacts(tool):
+                return True
+            result = function()
+            if result is not False and self.settings.get("artifact_cache"):
+                try:
+                    ArtifactCache(self.settings["artifact_cache"]).store(self.get_artifact_key(tool),
+                                                                         self.get_artifact_files(tool))
+                except Exception as e:
+                    print(e)
+            return result
+        return run_cached
+
+    def restore_cached_stages(self):
+        # MZmine outputs in the artifact cache are restored before msconvert, only MZmine reads the mzXML and xml
+        # so an unchanged raw file resumes after mzmine without decoding the raw file (morpheus is checked
+        # when it would be started, see convert)
+        if not self.settings.get("artifact_cache") or not self.needs_stage("mzmine"):
+            return
+        if self.restore_artifacts("mzmine"):
+            self.resume_stage = self.stages[self.stages.index("mzmine") + 1]
+
+    def restore_artifacts(self, tool):
+        if not self.settings.get("artifact_cache"):
             return False
+        try:
+            cache = ArtifactCache(self.settings["artifact_cache"])
+            if cache.restore(self.get_artifact_key(tool), self.get_artifact_files(tool)):
+                print("Reused cached " + tool + " outputs for " + self.file_name)
+                return True
+        except Exception as e:
+            print(e)
+        return False
+
+    def get_artifact_files(self, tool):
+        # {cached name: path} of the outputs later stages read
+        if tool == "mzmine":
+            files = {"posoutput.csv": self.outfiles_dir + "\\" + "posoutput.csv",
+                     "project.mzmine": self.outfiles_dir + "\\" + self.file_name + ".mzmine"}
+            if self.experiment == "METABOLOMICS":
+                files["negoutput.csv"] = self.outfiles_dir + "\\" + "negoutput.csv"
+            return files
+        return {"summary.tsv": self.morph_out_dir + "\\" + "summary.tsv",
+                "PSMs.tsv": self.morph_out_dir + "\\" + self.file_name + ".PSMs.tsv"}
+
+    def get_artifact_key(self, tool):
+        # raw file content, tool configuration and tool version
+        # raw file: the md5 from its scratch copy (see fetch_raw_file), without one the size and mtime
+        # so the raw file isn't read over the network just for the key
+        cache = ArtifactCache(self.settings["artifact_cache"])
+        if self.raw_hash is None:
+            stat = os.stat(self.raw_file)
+            self.raw_hash = str(stat.st_size) + " " + str(stat.st_mtime)
+
+        parts = [self.raw_hash, self.file_name, self.experiment]
+        if tool == "mzmine":
+            template = self.fs.xml_template_metab if self.experiment == "METABOLOMICS" else self.fs.xml_template_proteo
+            config_files = [template]
+            if self.experiment == "METABOLOMICS":
+                config_files += [self.fs.pos_db, self.fs.neg_db]
+            else:
+                config_files.append(self.fs.irt_db)
+            parts += [file_md5(config_file) for config_file in config_files]
+            parts.append("MZmine-2.32")
         else:
+            # options without the file paths and thread count (doesn't change the results), plus the fasta and program
+            options = self.morpheus_options("DATA", "..OUT")
+            options.pop('-mt')
+            parts.append(' '.join(['%s %s' % (key, options[key]) for key in options]))
+            for name in ["HUMAN.fasta", "morpheus_tmo_cl.exe"]:
+                path = self.morpheus_dir() + "\\" + name
+                if os.path.isfile(path):
+                    parts.append(str(os.path.getsize(path)) + " " + str(os.path.getmtime(path)))
+        return cache.get_key(tool, *parts)
+
+    def needs_stage(self, stage):
+        # stages before the resume stage were completed by an earlier attempt
+        return self.stages.index(stage) >= self.stages.index(self.resume_stage)
+
+    def run_stage(self, stage, function):
+        if not self.needs_stage(stage):
             return True
 
+        # function returns False on failure (None counts as success)
+        if function() is False:
+            return False
+
+        self.ledger.mark(stage)
+        return True
+
+    def run_mzmine(self):
+        command = 'startMZmine_Windows.bat ' + '"' + self.outfiles_dir + "\\"+ self.file_name + '.xml' + '"'
+        return self.run_tool("mzmine", command, self.fs.sw_dir + "\\" + "MZmine-2.32")
+
+    def run_tool(self, tool, command, cwd):
+        # timeout, retries and output captured to <tool>.log in the outfiles folder (see ToolRunner)
+        runner = ToolRunner(tool, self.settings, self.outfiles_dir + "\\" + tool + ".log")
+        return runner.run(command, cwd)
+
     def run_mzmine_sub(self):
         # using subprocess if needed
-        os.chdir(self.fs.sw_dir + "\\" + "MZmine-2.32")
-        p = subprocess.Popen(['startMZmine_Windows.bat',  self.outfiles_dir + "\\" + self.file_name + '.xml'], stdout=subprocess.PIPE)
+        p = subprocess.Popen(['startMZmine_Windows.bat',  self.outfiles_dir + "\\" + self.file_name + '.xml'],
+                             stdout=subprocess.PIPE, cwd=self.fs.sw_dir + "\\" + "MZmine-2.32", shell=True)
         p.communicate()
         returnvalue = p.poll()
         # stupid backward logic
@@ -119,6 +375,26 @@ class ProcessRawFile:
         else:
             return True
 
+    def start_morpheus(self):
+        # run morpheus in a thread, joined before its results are inserted
+        self.morpheus_thread = threading.Thread(target=self.run_morpheus_thread, name="morpheus-" + self.file_name)
+        self.morpheus_thread.start()
+
+    def run_morpheus_thread(self):
+        try:
+            self.morpheus_result = self.run_morpheus()
+        except Exception as e:
+            print(e)
+            self.morpheus_result = False
+
+    def join_morpheus(self):
+        # wait for morpheus, runs it now if it wasn't started
+        if self.morpheus_thread is None:
+            return self.run_morpheus()
+        self.morpheus_thread.join()
+        self.morpheus_thread = None
+        return self.morpheus_result
+
     def run_morpheus(self):
 
         # runs morpheus for thermo files and windows only
@@ -127,17 +403,23 @@ class ProcessRawFile:
         #        removes C: (by splicing below) which means the path starts with /
         #           This is a path relative to the current drive root (WATCH for production env)
         # NOTE 4 MULTIPROCESSING: -mt flag sets threads, default will create as many threads as cpus
-
-        morph_db = "HUMAN.fasta"
-        morph_dir = self.fs.sw_dir + "\\" + "Morpheus" + "\\" + "morpheus" + "\\" + "thermo"
+        #       so it is set to share the cores with msconvert/mzmine running at the same time
 
         if not os.path.isdir(self.morph_out_dir):
             os.makedirs(self.morph_out_dir)
-        os.chdir(morph_dir)
 
+        # run morpheus (relative -o path is resolved against the morpheus drive)
+        return self.run_tool("morpheus", self.morpheus_command(self.raw_file, self.morph_out_dir), self.morpheus_dir())
+
+    def morpheus_dir(self):
+        return self.fs.sw_dir + "\\" + "Morpheus" + "\\" + "morpheus" + "\\" + "thermo"
+
+    def morpheus_options(self, data, out_dir):
+        # data is a raw file, or comma separated raw files for a MorpheusBatch
+        morph_db = "HUMAN.fasta"
         options = {
-                '-d': self.raw_file,
-                '-o': self.morph_out_dir[2:], # remove splicing for VM ???!!!
+                '-d': data,
+                '-o': out_dir[2:], # remove splicing for VM ???!!!
                 '-db': morph_db,
                 '-ad': 'true',
                 '-mmu': 'true',
@@ -150,37 +432,38 @@ class ProcessRawFile:
                 '-maxpmo': '+1',
                 '-vm': 'Ox',
                 '-fm': 'AlkC',
-                '-acs': 'false'
+                '-acs': 'false',
+                '-mt': str(self.morpheus_threads)
             }
         #print(options)
+        return options
+
+    def morpheus_command(self, data, out_dir):
+        options = self.morpheus_options(data, out_dir)
         command = 'morpheus_tmo_cl'
 
         # convert options to string for command line
         option_str = ''
         for key in options:
             option_str += ' %s \'%s\'' % (key, options[key])
-        command = command + ' ' + option_str
-
-        # run morpheus
-        returnvalue = os.system(command)
-        if returnvalue:
-            return False
-        else:
-            return True
+        return command + ' ' + option_str
 
     def run_msconvert(self):
         '''Creates .mzXML files in OutFiles'''
 
-        # go to s/w location
-        os.chdir(self.fs.sw_dir + "\ProteoWizard")
+        # run from s/w location
+        msconvert_dir = self.fs.sw_dir + "\\" + "ProteoWizard"
+
+        # metabolomics files switch polarity, decode once and split the scans
+        if self.experiment == "METABOLOMICS" and self.run_msconvert_split(msconvert_dir):
+            return True
 
         # run positive
         command = 'msconvert ' + '"' + self.raw_file + '"' \
                   + ' --filter ' + '"peakPicking true 1-"' + ' --filter ' + '"polarity positive"' \
                   + ' --mzXML -o ' + '"' + self.outfiles_dir + '"' + ' --outfile ' + '"' + self.file_name \
                   + '"' + '_pos'
-        returnvalue = os.system(command)
-        if returnvalue:
+        if not self.run_tool("msconvert", command, msconvert_dir):
             return False
 
         if self.experiment == "METABOLOMICS":
@@ -189,12 +472,30 @@ class ProcessRawFile:
                       + ' --filter ' + '"peakPicking true 1-"' + ' --filter ' + '"polarity negative"' \
                       + ' --mzXML -o ' + '"' + self.outfiles_dir + '"' + ' --outfile ' + '"' + self.file_name \
                       + '"' + '_neg'
-            returnvalue = os.system(command)
-            if returnvalue:
+            if not self.run_tool("msconvert", command, msconvert_dir):
                 return False
 
         return True
 
+    def run_msconvert_split(self, msconvert_dir):
+        # one msconvert run for both polarities then MzXMLSplit, False to fall back to a run per polarity
+        all_file = self.outfiles_dir + "\\" + self.file_name + "_all.mzXML"
+        command = 'msconvert ' + '"' + self.raw_file + '"' \
+                  + ' --filter ' + '"peakPicking true 1-"' \
+                  + ' --mzXML -o ' + '"' + self.outfiles_dir + '"' + ' --outfile ' + '"' + self.file_name \
+                  + '"' + '_all'
+        if not self.run_tool("msconvert", command, msconvert_dir) or not os.path.isfile(all_file):
+            return False
+
+        try:
+            split = MzXMLSplit(all_file).split(self.outfiles_dir + "\\" + self.file_name + "_pos.mzXML",
+                                               self.outfiles_dir + "\\" + self.file_name + "_neg.mzXML")
+        except Exception as e:
+            print(e)
+            split = False
+        os.remove(all_file)
+        return split
+
     # CHECK
     def check_run(self):
         # check hasn't already been inserted
@@ -206,18 +507,21 @@ class ProcessRawFile:
             print(e)
 
         # UPDATE code for proteomics (chroms and pressure)..remove and restore Boolean return b4 next processing
-        if len(data) > 0:
+        # keep the run if resuming after it was inserted
+        if len(data) > 0 and self.stages.index(self.resume_stage) <= self.stages.index("qc_run"):
 
-            # get run id
+            # get run id (not a cached one, another process may have inserted it again)
+            self.db.invalidate("run", self.file_name)
             run_id = self.db.get_run_id(self.file_name)
 
             # delete
             sql = "DELETE from qc_run WHERE run_id = '" + str(run_id) + "'"
             try:
                 self.db.cursor.execute(sql)
-                self.db.db.commit()
+                self.db.commit()
             except Exception as e:
                 print(e)
+            self.db.invalidate("run", self.file_name)
 
         return False
 
@@ -233,6 +537,12 @@ class ProcessRawFile:
             return False
 
     # CREATE
+    def create_xml(self):
+        if self.experiment == "METABOLOMICS":
+            self.create_metab_xml()
+        elif self.experiment == "PROTEOMICS":
+            self.create_proteo_xml()
+
     def create_metab_xml(self):
         pos_file = self.outfiles_dir + "\\" + self.file_name + "_pos.mzXML"
         neg_file = self.outfiles_dir + "\\" + self.file_name + "_neg.mzXML"
@@ -249,7 +559,6 @@ class ProcessRawFile:
         #print(neg_file)
 
         new_xml = []
-        os.chdir(self.fs.main_dir)
         with open(self.fs.xml_template_metab, 'r') as infile:
             for line in infile:
                 #print(line)
@@ -277,7 +586,6 @@ class ProcessRawFile:
         output_file = self.outfiles_dir
 
         new_xml = []
-        os.chdir(self.fs.main_dir)
         with open(self.fs.xml_template_proteo, 'r') as infile:
             for line in infile:
                 #print(line)
@@ -298,6 +606,9 @@ class ProcessRawFile:
     # INSERT
     def insert_morpheus(self):
 
+        # clear anything left by an interrupted attempt
+        self.delete_measurements("morpheus")
+
         # read and insert summary data from morpheus
         with open(self.morph_out_dir + '\\' + 'summary.tsv', 'r') as infile:
             lines = infile.readlines()
@@ -313,27 +624,17 @@ class ProcessRawFile:
         run_id = self.db.get_run_id(self.file_name)
 
         # get hela component_id
-        sql = "SELECT component_id FROM sample_component WHERE component_name = 'Hela Digest'"
-        try:
-            self.db.cursor.execute(sql)
-            hela_id = self.db.cursor.fetchone()[0]
-        except Exception as e:
-            print(e)
+        hela_id = self.db.get_component_id('Hela Digest')
 
         for key in summary:
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = '" + key.strip() + "'"
-            try:
-                self.db.cursor.execute(sql)
-                met_id = self.db.cursor.fetchone()
-            except Exception as e:
-                print(e)
+            met_id = self.db.get_metric_id(key.strip())
 
             # insert measurement
-            if met_id is not None:
-                #print(met_id[0])
+            if met_id:
+                #print(met_id)
                 #print(summary[key])
-                sql = "INSERT INTO measurement VALUES ( '" + str(met_id[0]) + "','" + str(hela_id) + \
+                sql = "INSERT INTO measurement VALUES ( '" + str(met_id) + "','" + str(hela_id) + \
                       "','" + str(run_id) + "','" + str(summary[key]) + "')"
 
                 try:
@@ -341,7 +642,7 @@ class ProcessRawFile:
                 except Exception as e:
                     print(e)
 
-                self.db.db.commit()
+                self.db.commit()
 
         self.insert_morpheus_ppms(run_id, hela_id)
 
@@ -380,15 +681,10 @@ class ProcessRawFile:
 
 
         # get id for Precursor Mass Error
-        sql = "SELECT metric_id FROM metric WHERE metric_name = 'Precursor Mass Error'"
-        try:
-            self.db.cursor.execute(sql)
-            mid = self.db.cursor.fetchone()
-        except Exception as e:
-            print(e)
+        mid = self.db.get_metric_id('Precursor Mass Error')
 
         # insert
-        sql = "INSERT INTO measurement VALUES ( '" + str(mid[0]) + "','" + str(hid) + \
+        sql = "INSERT INTO measurement VALUES ( '" + str(mid) + "','" + str(hid) + \
               "','" + str(rid) + "','" + str(average) + "')"
 
         try:
@@ -396,146 +692,90 @@ class ProcessRawFile:
         except Exception as e:
             print(e)
 
-        self.db.db.commit()
-
-    def insert_pos_csv(self):
-        # insert pos for v4
-        # relies on INSERT ORDER (from DB) REFACTOR?
-        # mz, rt, height, area, fwhm, tf, af, min, max, (ppm), (dalton), (areaN), (heightN)
-        # change metric names in xml templates and rewrite all insert functions to use names
-
-        run_id = self.db.get_run_id(self.file_name)
-
-        with open(self.outfiles_dir + "\\" +  'posoutput.csv', 'r') as incsv:
-            for line in incsv:
-                in_data = line.strip().split("|")
-                #print(in_data)
-                if in_data[0][0] != 'r': # skip first line
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + in_data[0] + "'"
-                    try:
-                        self.db.cursor.execute(sql)
-                        comp_id = self.db.cursor.fetchone()
-                        #print(comp_id)
-                    except Exception as e:
-                        print(e)
-
-                    for i in range(1, 10): # watch i as metric id here REFACTOR change metric names to mzmine and get ids
-                        # handle nulls, put to 0, other values ??
-                        ins_value = str(in_data[i])
-                        if ins_value == 'null':
-                            ins_value = '0'
-                        ins_sql = "INSERT INTO measurement VALUES( " + "'" + str(i) + "', '" + str(comp_id[0]) \
-                                  + "', '" + str(run_id) + "', '" + ins_value + "')"
-                        try:
-                            self.db.cursor.execute(ins_sql)
-                            self.db.db.commit()
-                        except Exception as e:
-                            print(e)
-
-                    self.insert_derived_errors(run_id, comp_id[0])
-
-    def insert_neg_csv(self):
-        # insert neg for v4
-        # INSERT ORDER (from DB)
-        # mz, rt, height, area, fwhm, tf, af, min, max, ppm, dalton, areaN, heightN
+        self.db.commit()
 
-        # get run_id
+    def insert_csv(self):
+        # all of the run's mzmine measurements in one multi-row INSERT and one transaction,
+        # so a failed insert leaves nothing behind and the stage is retried
+        # clear anything left by an interrupted attempt before inserting
+        self.delete_measurements("mzmine")
         run_id = self.db.get_run_id(self.file_name)
 
-        with open(self.outfiles_dir + "\\" +  'negoutput.csv', 'r') as incsv:
-            for line in incsv:
-                in_data = line.strip().split("|")
-                #print(in_data)
-                if in_data[0][0] != 'r': # skip first line
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + in_data[0] + "'"
-                    try:
-                        self.db.cursor.execute(sql)
-                        comp_id = self.db.cursor.fetchone()
-                        #print(comp_id)
-                    except Exception as e:
-                        print(e)
-
-                    for i in range(1, 10):
-                        # handle nulls, put to 0, other values ??
-                        ins_value = str(in_data[i])
-                        if ins_value == 'null':
-                            ins_value = '0'
-                        ins_sql = "INSERT INTO measurement VALUES( " + "'" + str(i) + "', '" + str(comp_id[0]) \
-                                  + "', '" + str(run_id) + "', '" + ins_value + "')"
-                        try:
-                            self.db.cursor.execute(ins_sql)
-                            self.db.db.commit()
-                        except Exception as e:
-                           print("Database from Process: insert neg csv")
-
-                    self.insert_derived_errors(run_id, comp_id[0])
-
-    def insert_derived_errors(self, r_id, c_id):
-        sql = "SELECT exp_mass_charge FROM sample_component WHERE component_id = " + str(c_id)
-        try:
-            self.db.cursor.execute(sql)
-            emc = self.db.cursor.fetchone()
-        except Exception as e:
-            print(e)
-
+        csv_files = ['posoutput.csv']
+        if self.experiment == "METABOLOMICS":
+            csv_files.append('negoutput.csv')
 
-        sql2 = "SELECT value FROM measurement WHERE component_id = " + str(c_id) + " AND run_id = " \
-               + str(r_id) + " AND metric_id = 1"
         try:
-            self.db.cursor.execute(sql2)
-            m_value = self.db.cursor.fetchone()
+            peaks = pd.concat([self.read_mzmine_csv(csv_file) for csv_file in csv_files], ignore_index=True)
+            measurements = self.get_mzmine_measurements(run_id, peaks)
+            self.db.cursor.executemany("INSERT INTO measurement VALUES (%s, %s, %s, %s)", measurements)
+            self.db.commit()
         except Exception as e:
             print(e)
+            print("Database from Process: insert csv " + self.file_name)
+            self.db.rollback()
+            return False
 
-        # data type nightmare c/o mysql and python
-        diff = Decimal(m_value[0]) - Decimal(emc[0])
-        ppm = (diff/emc[0]) * Decimal(1e6)
-        dalton = diff * Decimal(1e3)
-        #print(diff)
-        #print(ppm)
-        #print(dalton)
-
-        # WATCH: hard coded metric ids based on order from config file
-        #        change to selects from db
-        ins_sql1 = "INSERT INTO measurement VALUES( " + "'" + "10" + "', '" + str(c_id) \
-                                    + "', '" + str(r_id) + "', '" + str(ppm) + "')"
-
-        ins_sql2 = "INSERT INTO measurement VALUES( " + "'" + "11" + "', '" + str(c_id) \
-                   + "', '" + str(r_id) + "', '" + str(dalton) + "')"
-
-        try:
-            self.db.cursor.execute(ins_sql1)
-            self.db.cursor.execute(ins_sql2)
-            self.db.db.commit()
-        except Exception as e:
-            print(e)
+    def read_mzmine_csv(self, csv_file):
+        # '|' separated with a header row, row identity (component name) then MZMINE_COLUMNS,
+        # MZmine ends each line with a separator (ignored), nulls are put to 0
+        peaks = pd.read_csv(self.outfiles_dir + "\\" + csv_file, sep="|", index_col=False, na_values=["null"],
+                            keep_default_na=False)
+        peaks = peaks.iloc[:, :len(self.MZMINE_COLUMNS) + 1].copy()
+        peaks.columns = ["component"] + self.MZMINE_COLUMNS
+
+        # anything else that isn't a finite number (eg. NaN, Infinity, empty) is put to 0 as well,
+        # so one bad value can't fail the run's insert
+        metrics = peaks[self.MZMINE_COLUMNS].apply(pd.to_numeric, errors="coerce")
+        metrics = metrics.mask(metrics.abs() == float("inf"))
+        invalid = metrics.isnull() & peaks[self.MZMINE_COLUMNS].notnull()
+        for name in peaks.loc[invalid.any(axis=1), "component"]:
+            print("Not a number put to 0 for " + str(name) + " in " + csv_file + " " + self.file_name)
+        peaks[self.MZMINE_COLUMNS] = metrics.fillna(0)
+
+        # component ids and expected mz from the db id cache, rows for unknown components are dropped
+        peaks = peaks.merge(self.get_components(), on="component", how="left")
+        for name in peaks.loc[peaks["component_id"].isnull(), "component"]:
+            print("Unknown component " + str(name) + " in " + csv_file + " " + self.file_name)
+        peaks = peaks.dropna(subset=["component_id"]).astype({"component_id": int})
+
+        # derived metrics, mass errors against the expected mz and fwhm from minutes to seconds
+        diff = peaks["mz"] - peaks["exp_mass_charge"]
+        peaks["mass_error_ppm"] = diff / peaks["exp_mass_charge"] * 1e6
+        peaks["mass_error_dalton"] = diff * 1e3
+        peaks["fwhm"] = peaks["fwhm"] * 60
+        # a component without an expected mz has no mass error
+        derived = peaks[self.DERIVED_COLUMNS]
+        peaks[self.DERIVED_COLUMNS] = derived.mask(derived.abs() == float("inf")).fillna(0)
+        return peaks
+
+    def get_mzmine_measurements(self, run_id, peaks):
+        # (metric_id, component_id, run_id, value) rows, one per component and mzmine column or derived metric
+        metric_ids = self.db.get_ids("metric")
+        values = peaks.melt(id_vars=["component_id"], value_vars=self.MZMINE_COLUMNS + self.DERIVED_COLUMNS,
+                            var_name="metric", value_name="value")
+        return list(zip(values["metric"].map(metric_ids).tolist(), values["component_id"].tolist(),
+                        [run_id] * len(values), values["value"].tolist()))
+
+    def get_components(self):
+        # component, component_id, exp_mass_charge table from the db id cache
+        component_ids = self.db.get_ids("component")
+        exp_mass_charges = self.db.get_ids("exp_mass_charge")
+        components = pd.DataFrame({"component": list(component_ids), "component_id": list(component_ids.values())})
+        components["exp_mass_charge"] = components["component"].map(exp_mass_charges).astype(float)
+        return components
 
     def insert_qc_run_data(self):
 
-        # get id for experiment
-        e_sql = "SELECT experiment_id FROM experiment WHERE experiment_type = '" + self.experiment.lower() + "'"
-
-        try:
-            self.db.cursor.execute(e_sql)
-            eid = self.db.cursor.fetchone()
-            self.eid = eid[0] # store for stats
-        except Exception as e:
-           print(e)
-
-        # get machine id
-        m_sql = "SELECT machine_id FROM machine WHERE machine_name = " + "'" + self.machine + "'"
-
-        try:
-            self.db.cursor.execute(m_sql)
-            mid = self.db.cursor.fetchone()
-        except Exception as e:
-            print(e)
+        # get ids for experiment (stored for stats) and machine
+        self.eid = self.db.get_experiment_id(self.experiment)
+        mid = self.db.get_machine_id(self.machine)
 
 
         run_date = self.get_run_date_time()
 
         sql = "INSERT INTO qc_run(run_id, file_name, date_time, machine_id, experiment_id, completed) VALUES(NULL,'" \
-              + self.file_name + "', CONVERT('" + str(run_date) + "', DATETIME)" + ",'" + str(mid[0]) + \
+              + self.file_name + "', CONVERT('" + str(run_date) + "', DATETIME)" + ",'" + str(mid) + \
                "','" + str(self.eid) + "','N'" + ")"
         try:
             self.db.cursor.execute(sql)
@@ -543,7 +783,8 @@ class ProcessRawFile:
             print(e)
             return False
 
-        self.db.db.commit()
+        self.db.commit()
+        self.db.invalidate("run", self.file_name)
         return True
 
     def insert_summary(self, s_data):
@@ -557,11 +798,35 @@ class ProcessRawFile:
 
         try:
             self.db.cursor.execute(sql)
-            self.db.db.commit()
+            self.db.commit()
         except Exception as e:
             print(e)
 
     # EMAIL
+    def check_thresholds_and_email(self):
+        if self.experiment == "METABOLOMICS":
+            email_data = self.check_email_thresholds_metab()
+        else:
+            email_data = self.check_email_thresholds_prot()
+        self.insert_summary(email_data)
+        if len(email_data) > 0 and self.send_email:
+            # sent once the run is committed (see send_threshold_email)
+            email_data['metadata'] = self.metadata
+            self.email_data = email_data
+        else:
+            print("No Email Sent")
+
+    def send_threshold_email(self):
+        # after the run's unit of work is committed, so a run that was rolled back sends no email
+        if self.email_data is None:
+            return
+        try:
+            SendEmail(self.email_data, self.db, self.fs)
+        except Exception as e:
+            print(e)
+            print("Email error " + self.file_name)
+        self.email_data = None
+
     def check_email_thresholds_prot(self):
         # checks metric values against the thresholds in config files
         # and sends email if any outsdide limits
@@ -592,9 +857,7 @@ class ProcessRawFile:
             upper = thresholds[metric][2]
 
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "'"
-            self.db.cursor.execute(sql)
-            metric_id = self.db.cursor.fetchone()[0]
+            metric_id = self.db.get_metric_id(metric)
 
             # get values for metric and run_id
             sql = "SELECT c.component_name, v.value FROM " + \
@@ -719,10 +982,7 @@ class ProcessRawFile:
                         comps[metric] = [str(round(result[1], 3)) + " ppm"]
             elif metric == 'rt':
                 for result in results:
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + str(
-                        result[0]) + "'"
-                    self.db.cursor.execute(sql)
-                    comp_id = self.db.cursor.fetchone()[0]
+                    comp_id = self.db.get_component_id(str(result[0]))
 
                     # get all values per component
                     sql = "SELECT value FROM measurement WHERE metric_id = " + "'" + str(metric_id) + "'" + \
@@ -783,9 +1043,7 @@ class ProcessRawFile:
             upper = thresholds[metric][2]
 
             # get metric_id
-            sql = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "'"
-            self.db.cursor.execute(sql)
-            metric_id = self.db.cursor.fetchone()[0]
+            metric_id = self.db.get_metric_id(metric)
 
             # get values for metric and run_id (not limited by polarity)
             sql = "SELECT c.component_name, v.value FROM " + \
@@ -833,10 +1091,7 @@ class ProcessRawFile:
                             breaches[metric + "_Pos"] = comps
             elif metric == 'rt':
                 for result in results:
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + str(
-                        result[0]) + "'"
-                    self.db.cursor.execute(sql)
-                    comp_id = self.db.cursor.fetchone()[0]
+                    comp_id = self.db.get_component_id(str(result[0]))
 
                     # get all values per component
                     sql = "SELECT value FROM measurement WHERE metric_id = " + "'" + str(metric_id) + "'" + \
@@ -867,10 +1122,7 @@ class ProcessRawFile:
                     breaches[metric] = comps
             elif metric == 'area_normalised':
                 for result in results:
-                    sql = "SELECT component_id FROM sample_component WHERE component_name = " + "'" + str(
-                        result[0]) + "'"
-                    self.db.cursor.execute(sql)
-                    comp_id = self.db.cursor.fetchone()[0]
+                    comp_id = self.db.get_component_id(str(result[0]))
 
                     # get all values per component
                     sql = "SELECT value FROM measurement WHERE metric_id = " + "'" + str(metric_id) + "'" + \
@@ -902,34 +1154,6 @@ class ProcessRawFile:
         return breaches
 
     # OTHER
-    def fwhm_to_seconds(self):
-        sql = "SELECT metric_id FROM metric WHERE metric_name = 'fwhm'"
-
-        try:
-            self.db.cursor.execute(sql)
-            fwhm_id = self.db.cursor.fetchone()[0]
-        except Exception as e:
-            print(e)
-
-        sql = "SELECT run_id FROM qc_run WHERE file_name = " + "'" + self.file_name + "'"
-
-        try:
-            self.db.cursor.execute(sql)
-            run_id = self.db.cursor.fetchone()[0]
-        except Exception as e:
-            print(e)
-
-        update_sql = "UPDATE measurement SET value = value*60 WHERE run_id = " + "'" + str(run_id) + "'" + \
-                    " AND metric_id = " + "'" + str(fwhm_id) + "'"
-
-
-        try:
-            self.db.cursor.execute(update_sql)
-            self.db.db.commit()
-            #print("Updated fwhm  for " + str(self.file_name))
-        except Exception as e:
-            print(e)
-
     def get_run_date_time(self):
         return self.file_name[-12:]
 
@@ -964,6 +1188,18 @@ class ProcessRawFile:
         except Exception as e:
             print(e)
 
+    def delete_measurements(self, metric_type):
+        # remove a run's measurements of one metric type
+        run_id = self.db.get_run_id(self.file_name)
+        sql = "DELETE FROM measurement WHERE run_id = '" + str(run_id) + "' AND metric_id IN " + \
+              "(SELECT metric_id FROM metric WHERE metric_type = '" + metric_type + "')"
+
+        try:
+            self.db.cursor.execute(sql)
+            self.db.commit()
+        except Exception as e:
+            print(e)
+
     def delete_files(self):
 
         # ADD: removal of .scans from chromatograms
@@ -990,13 +1226,7 @@ class ProcessRawFile:
     def get_recent_runs(self, machine):
 
         # get machine id
-        sql = "SELECT machine_id FROM machine WHERE machine_name ='" + machine + "'"
-
-        try:
-            db.cursor.execute(sql)
-            m_id = db.cursor.fetchone()[0]
-        except Exception as e:
-            print(e)
+        m_id = db.get_machine_id(machine)
 
         # get last 20 runs
         sql = "SELECT file_name FROM qc_run WHERE machine_id ='" + str(m_id) + "'" + \
@@ -1011,102 +1241,701 @@ class ProcessRawFile:
         return files
 
 
-if __name__ == "__main__":
-    # REFACTOR: config from files (using venue?, plus metab set for one machine)
+def get_machine_names(db, loc, experiment_type):
+    # get machine names and types for venue and experiment type
+    if experiment_type == "METABOLOMICS":
+        sql = "SELECT machine_name, machine_type FROM machine WHERE" + " machine_venue = '" + loc + "' AND use_metab = 'Y'"
+    elif experiment_type == "PROTEOMICS":
+        sql = "SELECT machine_name, machine_type FROM machine WHERE" + " machine_venue = '" + loc + "' AND use_prot = 'Y'"
+    else:
+        print("Enter metabolomics or proteomics")
+        return None
 
-    # set database details, put in config file
-    db_info = {"user": "root", "password": "", "database": "mpmfdb"}
-    loc = sys.argv[3].upper()
-    experiment_type = sys.argv[4].upper()
+    try:
+        db.cursor.execute(sql)
+        return db.cursor.fetchall()
+    except Exception as e:
+        print(e)
+        print("Could not get machines")
+        return None
 
-    # get file system (x 2) and database objects
-    fs = FileSystem(sys.argv[1], "", "", "")
-    fs2 = FileSystem(sys.argv[1], sys.argv[2], loc, experiment_type) # used in processing and chrom
-    db = MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], fs)
 
-    # PROTEOMICS in_dir "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\qc_automation"
-    # METABOLOMICS in_dir "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\Metabolomics\QC_runs"
+def get_raw_file_dirs(fs, loc, experiment_type, machine_names):
+    # returns {machine: [raw file directory, raw file pattern, machine type]}
 
-    # get machine names for venue and experiment type
+    # CONFIG: if more machines are added for metabolomics they need to be in machine named folders
+    #       and the set-up logic here will need to be modified as per proteomics processing (in REFACTOR)
+    raw_dirs = {}
+    if experiment_type == "METABOLOMICS":
+        if loc == 'CLAYTON':
+            raw_dirs[machine_names[0][0]] = [fs.in_dir + '\\' + 'C1_Clayton', 'QC_Metabolomics_*.raw', machine_names[0][1]]
+        elif loc == 'PARKVILLE':
+            raw_dirs[machine_names[0][0]] = [fs.in_dir + '\\' + 'C2_Parkville', 'M_QC_*.raw', machine_names[0][1]]
+        else:
+            print('Could not get files..')
+            return None
+    elif experiment_type == "PROTEOMICS":
+        for machine in machine_names:
+            raw_dirs[machine[0]] = [fs.in_dir + '\\' + machine[0] + '\\' + 'instrument_data', 'HelaiRT1ul_*.raw', machine[1]]
+
+    return raw_dirs
+
+
+def get_raw_files(raw_dirs, scanner, settle, limit=0):
+    # returns {machine: [raw files (newest first), machine type, listing]}, the newest limit files (0 for all)
+    # per machine, sorted on the mtimes from the directory listing {name: [size, mtime]} (see DirScanner)
+    # a newest file still being acquired is deferred, not replaced by the (already processed) one before it
     machines = {}
-    run_check = True
-    sql = ''
-    machine_names = ()
-
-    if experiment_type.strip() == "METABOLOMICS":
-        sql = "SELECT machine_name, machine_type FROM machine WHERE" + " machine_venue = '" + loc.strip() + "' AND use_metab = 'Y'"
-    elif experiment_type.strip() == "PROTEOMICS":
-        sql = "SELECT machine_name, machine_type FROM machine WHERE" + " machine_venue = '" + loc.strip() + "' AND use_prot = 'Y'"
-    else:
-        print("Enter metabolomics or proteomics")
-        run_check = False
+    listing = scanner.scan(raw_dirs)
+    for machine in raw_dirs:
+        directory, pattern, machine_type = raw_dirs[machine]
+        raw_files = scanner.get_paths(directory, listing[machine])
+        if limit > 0:
+            raw_files = raw_files[:limit]
+        machines[machine] = [get_acquired(raw_files, listing[machine], settle, scanner.get_previous(directory)),
+                             machine_type, listing[machine]]
+
+    return machines
+
+
+def get_new_raw_files(raw_dirs, index, keep, scanner, settle):
+    # returns {machine: [new raw files (newest first), machine type, listing]} for machines with new arrivals
+    # files still being acquired aren't marked in the index so they are picked up on a later poll
+    machines = {}
+    listing = scanner.scan(raw_dirs)
+    for machine in raw_dirs:
+        directory, pattern, machine_type = raw_dirs[machine]
+        raw_files = get_acquired(index.new_files(directory, pattern, keep, listing[machine]), listing[machine], settle,
+                                 scanner.get_previous(directory))
+        if len(raw_files) > 0:
+            machines[machine] = [raw_files, machine_type, listing[machine]]
+
+    return machines
+
+
+def get_acquired(raw_files, files, settle, previous=None):
+    # drop raw files the instrument is still writing, raw_files are the candidates left after any --limit
+    # files is the machine's DirScanner listing {name: [size, mtime]} and previous the listing before it
+    # (None for a directory not listed before), the listing can be stale for a file still open on the share
+    # so a file must also be unchanged since the previous listing and not held open by the instrument
+    acquired = []
+    for raw_file in raw_files:
+        name = raw_file.split("\\")[-1]
+        size, mtime = files[name]
+        if is_acquired(size, mtime, settle) and (previous is None or previous.get(name) == [size, mtime]) \
+                and not is_held_open(raw_file):
+            acquired.append(raw_file)
+        else:
+            print("Still acquiring, deferred " + get_file_name(raw_file))
+    return acquired
+
+
+def is_acquired(size, mtime, settle):
+    # cheap check before any tool is started: not empty and unchanged for settle seconds
+    return size > 0 and time.time() - mtime >= settle
 
-    if run_check:
+
+def is_held_open(raw_file):
+    # if we can write to it, the instrument still holding it open gives a sharing violation on windows
+    if os.access(raw_file, os.W_OK):
         try:
-            db.cursor.execute(sql)
-            machine_names = db.cursor.fetchall()
-        except Exception as e:
-            print(e)
-            print("Could not get machines")
-            run_check = False
+            with open(raw_file, 'r+b'):
+                pass
+        except OSError:
+            return True
+    return False
+
+
+def get_timeouts(timeouts):
+    # "tool=seconds,..." to {tool: seconds}, tools not given use the ToolRunner defaults
+    tool_timeouts = {}
+    for timeout in timeouts.split(","):
+        if "=" in timeout:
+            tool, seconds = timeout.split("=")
+            tool_timeouts[tool.strip().lower()] = int(seconds) or None
+    return tool_timeouts
+
+
+def get_footprints(footprints):
+    # "tool=GB:cores,..." to {tool: [GB, cores]}
+    tool_footprints = {}
+    for footprint in footprints.split(","):
+        if "=" in footprint:
+            tool, resources = footprint.split("=")
+            ram, cpus = resources.split(":")
+            tool_footprints[tool.strip().lower()] = [float(ram), int(cpus)]
+    return tool_footprints
+
+
+def get_stage_workers(stage_workers, default=(2, 1, 1)):
+    # "convert,mzmine,ingest" workers, stages not given use the default
+    workers = [max(int(n), 1) for n in stage_workers.split(",") if n.strip()][:len(default)]
+    return workers + list(default[len(workers):])
 
-    # CONFIG: if more machines are added for metabolomics they need to be in machine named folders
-    #       and the set-up logic here will need to be modified as per proteomics processing (in REFACTOR)
-    # PLUS sorting is MEGA slow?
-
-    # get raw files
-    raw_files = []
-    if run_check:
-        if experiment_type == "METABOLOMICS":
-            if loc.upper() == 'CLAYTON':
-                raw_files = glob.glob(fs.in_dir + '\\' + 'C1_Clayton' + '\\' + 'QC_Metabolomics_*.raw')
-                raw_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)  # sort
-            elif loc.upper() == 'PARKVILLE':
-                raw_files = glob.glob(fs.in_dir + '\\' + 'C2_Parkville' + '\\' + 'M_QC_*.raw')
-                raw_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)  # sort
-            else:
-                print('Could not get files..')
-                run_check = False
-            machines[machine_names[0][0]] = [raw_files, machine_names[0][1]]
-        elif experiment_type == "PROTEOMICS":
-            for machine in machine_names:
-                raw_files = glob.glob(fs.in_dir + '\\' + machine[0] + '\\' + 'instrument_data' + '\\' + 'HelaiRT1ul_*.raw')
-                raw_files.sort(key=lambda x: os.path.getmtime(x), reverse=True) #sort
-                machines[machine[0]] = [raw_files, machine[1]]
-
-    # loop through machines and process raw files
-    if run_check:
-        for machine in machines:
-            print("Found " + str(len(machines[machine][0])) + " files")
-            print("Venue " + loc + " Machine " + machine)
-
-            for k in range(len(machines[machine][0])):
-
-                # process only last 10 raw files, remove to process all
-                if k >= 1:
-                    break
 
-                # get file name
-                path_array = machines[machine][0][k].split('\\')
-                id = path_array[len(path_array) - 1][:-4] # REMOVE .RAW
+def get_file_name(raw_file):
+    path_array = raw_file.split('\\')
+    return path_array[len(path_array) - 1][:-4] # REMOVE .RAW
 
-                # process raw file for mzmine and morpheus metrics (changed to fs2, test next run)
-                qc_run = ProcessRawFile(id, machines[machine][0][k], machine, experiment_type, fs2, db_info, loc)
 
-                # only do thermo metrics, pressure and chroms if successsful metric (mzmine/morpheus) insert
-                if qc_run.run():
-                    # process instrument metrics for thermo machines
-                    if machines[machine][1] == "thermo":
-                        ThermoMetrics(machines[machine][0][k], id, experiment_type, db)
+def process_raw_file(job):
+    """
+        Processes one raw file end to end (mzmine/morpheus, thermo metrics and chromatograms)
+        Module level so it can be used as a multiprocessing pool task
+        Returns (machine, raw file, processed) so the caller knows when a machine's files have drained
+    """
+    raw_file, machine, machine_type, experiment_type, filesystem, db_info, venue, settings, mtime = job
+    file_name = get_file_name(raw_file)
+    processed = False
+    qc_run = None
+
+    try:
+        # process raw file for mzmine and morpheus metrics
+        qc_run = ProcessRawFile(file_name, raw_file, machine, experiment_type, filesystem, db_info, venue,
+                                settings=settings, machine_type=machine_type)
+
+        # check if a QC file, then run the stages not already completed for it
+        if qc_run.start():
+            try:
+                if qc_run.convert() and qc_run.process_mzmine():
+                    processed = ingest_run(job, qc_run)
+            finally:
+                qc_run.finish()
+    except SystemExit:
+        # don't take a pool worker down with the file
+        print("Processing exited " + file_name)
+    except Exception as e:
+        print(e)
+        print("Processing error " + file_name)
+    finally:
+        # connection back to the pool for the next file
+        if qc_run is not None:
+            qc_run.db.close()
+
+    return machine, raw_file, processed
+
+
+def ingest_run(job, qc_run, morpheus=None):
+    # the run's inserts, thermo metrics and chromatograms are one transaction (see MPMFDBSetUp.unit_of_work),
+    # so a failure leaves no part of the run behind and readers never see a partial run
+    # thermo metrics and chromatograms are read before the transaction is opened, their writes are staged
+    # (see MPMFDBSetUp.staged_run) and added to it once the run is inserted
+    # returns True once committed, the outputs are then published and any threshold email sent
+    morpheus_done = qc_run.complete_morpheus(morpheus)
+
+    # the connection may have been idle through MZmine and Morpheus, don't insert without the run's lock
+    if not qc_run.db.ping():
+        print("Lost run lock " + qc_run.file_name)
+        return False
+    with qc_run.db.staged_run(qc_run.file_name) as staged:
+        run_post_ingest(job, qc_run, staged)
 
-                    # extract and add chromatogram data
-                    Chromatogram(id, fs2, experiment_type, machine, db)
+    with qc_run.db.unit_of_work(qc_run.file_name) as unit:
+        if not qc_run.ingest(morpheus_done):
+            unit.fail()
+            return False
+        unit.add(staged, qc_run.db.get_run_id(qc_run.file_name))
+    if not unit.committed:
+        print("Insert rolled back " + qc_run.file_name)
+        return False
 
+    qc_run.send_threshold_email()
+    qc_run.publish()
+    return True
+
+
+def run_post_ingest(job, qc_run, unit=None):
+    # thermo metrics and chromatograms read different inputs and write different tables,
+    # so run them at the same time (each with its own connection, writes staged in unit, see ingest_run)
+    # the qc_run's raw file (scratch copy) and file system (local work folder) are used if set
+    raw_file, machine, machine_type, experiment_type, filesystem, db_info, venue, settings, mtime = job
+    file_name = get_file_name(raw_file)
+    skip = settings.get("skip", [])
+    stages = StageExecutor(db_info, qc_run.fs, unit)
+
+    # process instrument metrics for thermo machines
+    if machine_type == "thermo" and "thermo" not in skip:
+        stages.add("thermo", ThermoMetrics, qc_run.raw_file, file_name, experiment_type)
+
+    # extract and add chromatogram data
+    if "chromatogram" not in skip:
+        stages.add("chromatogram", Chromatogram, file_name, qc_run.fs, experiment_type, machine)
+    stages.run()
+
+
+def get_jobs(machines, experiment_type, filesystem, db_info, venue, limit, settings):
+    # returns the raw file jobs and the number of jobs per machine
+    # settings are the per file options (see ProcessRawFile)
+    jobs = []
+    remaining = {}
+    for machine in machines:
+        print("Found " + str(len(machines[machine][0])) + " files")
+        print("Venue " + venue + " Machine " + machine)
+
+        raw_files = machines[machine][0]
+        if limit > 0:
+            raw_files = raw_files[:limit]
+
+        # the listing's mtime goes with each job for scheduling (see schedule_jobs)
+        listing = machines[machine][2]
+        remaining[machine] = len(raw_files)
+        for raw_file in raw_files:
+            mtime = listing[raw_file.split("\\")[-1]][1]
+            jobs.append((raw_file, machine, machines[machine][1], experiment_type, filesystem, db_info, venue,
+                         settings, mtime))
+
+    return jobs, remaining
+
+
+def process_machines(machines, experiment_type, filesystem, db_info, venue, db, limit, options):
+    # process raw files (see run_jobs), stats run once per machine when its files drain
+    results = []
+    jobs, remaining = get_jobs(machines, experiment_type, filesystem, db_info, venue, limit, options["settings"])
+    jobs = schedule_jobs(jobs)
+
+    # machines with nothing to process still get their stats checked
+    for machine in machines:
+        if remaining[machine] == 0:
+            Stat(experiment_type, db, machine.strip(), machines[machine][1]).run()
+
+    for result in run_jobs(jobs, options):
+        results.append(result)
+        # keep the venue lock's session alive, stop if it was dropped and another run has the lock
+        if not db.ping():
+            print("Lost the lock for " + venue + " " + experiment_type + ", stopping")
+            break
+        machine = result[0]
+        remaining[machine] -= 1
+        if remaining[machine] == 0:
             # update stats and normalised metrics
-            new_stat = Stat(experiment_type, db, machine.strip(),  machines[machine][1])
+            new_stat = Stat(experiment_type, db, machine.strip(), machines[machine][1])
             new_stat.run()
 
+    return results
+
+
+def schedule_jobs(jobs):
+    # order jobs across machines: first each machine's latest file (newest machine first) so alerts stay fast,
+    # then one file per machine per round so a backlog on one instrument can't starve the others
+    queues = {}
+    for job in jobs:
+        if job[1] not in queues:
+            queues[job[1]] = []
+        queues[job[1]].append(job)
+
+    # mtimes from the directory listing carried in the jobs, nothing is stat'ed here
+    order = sorted(queues, key=lambda machine: queues[machine][0][8], reverse=True)
+    scheduled = []
+    for i in range(max([len(queues[machine]) for machine in queues] + [0])):
+        for machine in order:
+            if i < len(queues[machine]):
+                scheduled.append(queues[machine][i])
+
+    return scheduled
+
+
+def run_jobs(jobs, options):
+    # generator, yields (machine, raw file, processed) as files finish
+    # with a pipeline, tool batches, a process pool or one at a time
+    if len(jobs) == 0:
+        return
+
+    if options["pipeline"]:
+        for result in process_pipeline(jobs, options["stage_workers"], options["queue_size"]):
+            yield result
+    elif options["batch_size"] > 1:
+        for result in process_batches(jobs, options["batch_size"]):
+            yield result
+    elif options["workers"] > 1:
+        pool = mp.Pool(processes=options["workers"])
+        for result in pool.imap_unordered(process_raw_file, jobs):
+            yield result
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            yield process_raw_file(job)
+
+
+def get_backfill_files(raw_dirs, machine_filter, start_date, end_date, scanner, settle):
+    # returns {machine: [raw files (oldest first), machine type, listing]} acquired between the dates (inclusive)
+    raw_dirs = {machine: raw_dirs[machine] for machine in raw_dirs
+                if not machine_filter or machine.lower() in machine_filter}
+    machines = {}
+    listing = scanner.scan(raw_dirs)
+    for machine in raw_dirs:
+        directory, pattern, machine_type = raw_dirs[machine]
+        files = {}
+        for name in listing[machine]:
+            day = time.strftime("%Y-%m-%d", time.localtime(listing[machine][name][1]))
+            if (start_date == "" or day >= start_date) and (end_date == "" or day <= end_date):
+                files[name] = listing[machine][name]
+        raw_files = scanner.get_paths(directory, files, oldest_first=True)
+        machines[machine] = [get_acquired(raw_files, files, settle, scanner.get_previous(directory)), machine_type,
+                             files]
+
+    return machines
+
+
+def backfill(machines, experiment_type, filesystem, db_info, venue, db, options):
+    # process all the history for the machines, stats are run once at the end
+    jobs, remaining = get_jobs(machines, experiment_type, filesystem, db_info, venue, 0, options["settings"])
+    jobs = schedule_jobs(jobs)
+    print("Backfilling " + str(len(jobs)) + " raw files")
+
+    started = time.time()
+    done = 0
+    failed = 0
+    for machine, raw_file, processed in run_jobs(jobs, options):
+        done += 1
+        if not processed:
+            failed += 1
+        if not db.ping():
+            print("Lost the lock for " + venue + " " + experiment_type + ", stopping")
+            break
+
+        # progress and estimated time remaining
+        elapsed = time.time() - started
+        eta = elapsed / done * (len(jobs) - done)
+        print("Backfill " + str(done) + "/" + str(len(jobs)) + " (" + str(failed) + " failed) "
+              + str(datetime.timedelta(seconds=int(elapsed))) + " elapsed, ETA "
+              + str(datetime.timedelta(seconds=int(eta))) + " " + get_file_name(raw_file))
+
+    # update stats and normalised metrics
+    for machine in machines:
+        new_stat = Stat(experiment_type, db, machine.strip(), machines[machine][1])
+        new_stat.run()
+
+
+def process_pipeline(jobs, stage_workers, queue_size):
+    # overlap msconvert, mzmine and the database inserts across files
+    # generator, yields (machine, raw file, processed) as files finish
+    stages = [("convert", pipeline_convert, stage_workers[0]),
+              ("mzmine", pipeline_mzmine, stage_workers[1]),
+              ("ingest", pipeline_ingest, stage_workers[2])]
+    pipeline = Pipeline(stages, queue_size)
+
+    items = [{"job": job, "qc_run": None} for job in jobs]
+    for item, completed in pipeline.run(items):
+        # close files that dropped out or finished
+        if item["qc_run"] is not None:
+            item["qc_run"].finish()
+            item["qc_run"].db.close()
+        yield item["job"][1], item["job"][0], completed
+
+
+def pipeline_convert(item):
+    raw_file, machine, machine_type, experiment_type, filesystem, db_info, venue, settings, mtime = item["job"]
+    item["qc_run"] = ProcessRawFile(get_file_name(raw_file), raw_file, machine, experiment_type, filesystem,
+                                    db_info, venue, settings=settings, machine_type=machine_type)
+    return item["qc_run"].start() and item["qc_run"].convert()
+
+
+def pipeline_mzmine(item):
+    return item["qc_run"].process_mzmine()
+
+
+def pipeline_ingest(item):
+    return ingest_run(item["job"], item["qc_run"])
+
+
+def process_batches(jobs, batch_size):
+    # runs tools once per batch of raw files rather than once per file
+    # generator, yields (machine, raw file, processed) as files finish
+    for i in range(0, len(jobs), batch_size):
+        for result in process_batch(jobs[i:i + batch_size]):
+            yield result
+
+
+def process_batch(jobs):
+    results = []
+    qc_runs = []
+    for job in jobs:
+        raw_file, machine, machine_type, experiment_type, filesystem, db_info, venue, settings, mtime = job
+        try:
+            qc_run = ProcessRawFile(get_file_name(raw_file), raw_file, machine, experiment_type, filesystem,
+                                    db_info, venue, settings=settings, machine_type=machine_type)
+            if qc_run.start(early_morpheus=False) and qc_run.convert():
+                qc_runs.append((job, qc_run))
+                continue
+            qc_run.db.close()
+        except Exception as e:
+            print(e)
+            print("Processing error " + get_file_name(raw_file))
+        results.append((machine, raw_file, False))
+
+    # one mzmine run and one morpheus run (at the same time) for the files that still need them
+    mzmine_results = {}
+    morpheus_results = {}
+    if len(qc_runs) > 0:
+        mzmine_batch = MZmineBatch(qc_runs[0][1].fs, qc_runs[0][0][3])
+        morpheus_batch = MorpheusBatch(qc_runs[0][1].fs, qc_runs[0][0][3])
+        for job, qc_run in qc_runs:
+            if qc_run.needs_stage("mzmine") and not qc_run.restore_artifacts("mzmine"):
+                mzmine_batch.add(qc_run)
+            if "morpheus" in qc_run.stages and qc_run.needs_stage("morpheus") \
+                    and not qc_run.restore_artifacts("morpheus"):
+                morpheus_batch.add(qc_run)
+
+        morpheus_thread = threading.Thread(target=lambda: morpheus_results.update(morpheus_batch.run()),
+                                           name="morpheus-batch")
+        morpheus_thread.start()
+        mzmine_results = mzmine_batch.run()
+        morpheus_thread.join()
+
+    for job, qc_run in qc_runs:
+        processed = False
+        try:
+            mzmine = lambda: mzmine_results.get(qc_run.file_name, False)
+            morpheus = lambda: morpheus_results.get(qc_run.file_name, False)
+            if qc_run.process_mzmine(mzmine):
+                processed = ingest_run(job, qc_run, morpheus)
+        except SystemExit:
+            print("Processing exited " + qc_run.file_name)
+        except Exception as e:
+            print(e)
+            print("Processing error " + qc_run.file_name)
+        finally:
+            qc_run.finish()
+            qc_run.db.close()
+        results.append((job[1], job[0], processed))
+
+    return results
+
+
+def watch(raw_dirs, index, scanner, experiment_type, filesystem, db_info, venue, db, options, interval, keep, settle):
+    # long running: poll for new raw files, process them and persist the index
+    print("Watching " + str(len(raw_dirs)) + " machine directories every " + str(interval) + " sec")
+    try:
+        while True:
+            # every poll so a quiet night doesn't let the server drop the session holding the venue lock
+            if not db.ping():
+                print("Lost the lock for " + venue + " " + experiment_type + ", stopping")
+                index.save()
+                break
+            machines = get_new_raw_files(raw_dirs, index, keep, scanner, settle)
+            if machines:
+                results = process_machines(machines, experiment_type, filesystem, db_info, venue, db, 0, options)
+                for machine, raw_file, processed in results:
+                    index.mark_result(raw_dirs[machine][0], raw_file, processed)
+            index.save()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        index.save()
+        print("Stopped watching")
+
+
+def enqueue(machines, experiment_type, venue, db, limit, reset=False):
+    # add raw files to the shared job_queue table for --worker processes (on this or other hosts)
+    # reset queues files that are already done or failed again
+    db.create_table_job_queue()
+    queue = JobQueue(db.db)
+    jobs, remaining = get_jobs(machines, experiment_type, None, None, venue, limit, None)
+
+    # each machine's latest file goes in the priority lane (see schedule_jobs)
+    added = 0
+    queued_machines = set()
+    for job in schedule_jobs(jobs):
+        raw_file, machine, machine_type = job[0], job[1], job[2]
+        priority = 0 if machine in queued_machines else 1
+        queued_machines.add(machine)
+        if queue.enqueue(get_file_name(raw_file), raw_file, machine, machine_type, experiment_type, venue, priority,
+                         reset):
+            added += 1
+    print("Queued " + str(added) + " of " + str(len(jobs)) + " raw files")
+
+
+def start_workers(experiment_type, filesystem, db_info, venue, options, interval, lease):
+    # one worker per process, each with its own database connections
+    if options["workers"] <= 1:
+        work(experiment_type, filesystem, db_info, venue, options, interval, lease)
+        return
+
+    workers = []
+    for i in range(options["workers"]):
+        worker = mp.Process(target=work, args=(experiment_type, filesystem, db_info, venue, options, interval, lease))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+
+def work(experiment_type, filesystem, db_info, venue, options, interval, lease):
+    # claim raw files from the job_queue table until it is empty (or keep polling every interval seconds)
+    # stats are run for the machines processed each time the queue empties
+    connect = lambda: MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], filesystem).db
+    db = MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], filesystem)
+    db.create_table_job_queue()
+    queue = JobQueue(db.db, lease=lease)
+    print("Worker " + queue.worker + " started")
+
+    processed_machines = {}
+    row = None
+    try:
+        while True:
+            db.ping()
+            row = queue.claim(experiment_type, venue)
+            if row is None:
+                for machine in processed_machines:
+                    # update stats and normalised metrics
+                    Stat(experiment_type, db, machine.strip(), processed_machines[machine]).run()
+                processed_machines = {}
+                if interval <= 0:
+                    break
+                time.sleep(interval)
+                continue
+
+            job_id, raw_file, machine, machine_type = row
+            # queued jobs are already in order, the mtime isn't needed
+            job = (raw_file, machine, machine_type, experiment_type, filesystem, db_info, venue, options["settings"],
+                   0)
+            heartbeat = JobHeartbeat(job_id, connect, queue.worker, lease)
+            heartbeat.start()
+            try:
+                processed = process_raw_file(job)[2]
+            finally:
+                heartbeat.stop()
+            queue.complete(job_id, processed)
+            processed_machines[machine] = machine_type
+            row = None
+    except KeyboardInterrupt:
+        if row is not None:
+            queue.requeue(row[0])
+        print("Worker " + queue.worker + " stopped")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    # REFACTOR: config from files (using venue?, plus metab set for one machine)
 
+    parser = argparse.ArgumentParser(description="Process QC raw files for a venue and experiment type")
+    parser.add_argument("in_dir", help="raw file directory")
+    parser.add_argument("out_dir", help="output directory")
+    parser.add_argument("venue", help="venue name eg. clayton")
+    parser.add_argument("experiment", help="proteomics or metabolomics")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes used to process raw files (1 = serial)")
+    parser.add_argument("--limit", type=int, default=1,
+                        help="newest raw files to process per machine (0 = all)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap msconvert, mzmine and inserts across files in one process")
+    parser.add_argument("--stage-workers", default="2,1,1",
+                        help="pipeline workers for the convert, mzmine and insert stages")
+    parser.add_argument("--queue-size", type=int, default=2,
+                        help="files that can wait between pipeline stages")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="raw files per MZmine run (default 1, one run per file)")
+    parser.add_argument("--backfill", action="store_true",
+                        help="process all raw files (oldest first) between --from and --to, stats run once at the end")
+    parser.add_argument("--from", dest="from_date", default="", help="backfill start date YYYY-MM-DD")
+    parser.add_argument("--to", dest="to_date", default="", help="backfill end date YYYY-MM-DD")
+    parser.add_argument("--machines", default="", help="comma separated machines to process (default all)")
+    parser.add_argument("--skip", default="",
+                        help="comma separated steps to leave out: thermo, chromatogram, email")
+    parser.add_argument("--settle", type=int, default=120,
+                        help="seconds a raw file must be unchanged before it is processed")
+    parser.add_argument("--scratch", default="",
+                        help="local directory to copy raw files to before processing (default read from the share)")
+    parser.add_argument("--scratch-size", type=float, default=50,
+                        help="GB of raw file copies kept in --scratch")
+    parser.add_argument("--work-dir", default="",
+                        help="local directory for intermediate files, only --publish outputs are copied to out_dir")
+    parser.add_argument("--publish", default="*.csv,Morpheus\\summary.tsv",
+                        help="comma separated outputs copied to out_dir with --work-dir (add *.mzmine for the project)")
+    parser.add_argument("--timeouts", default="",
+                        help="tool timeouts in seconds eg. msconvert=1800,mzmine=3600,morpheus=7200 (0 for none)")
+    parser.add_argument("--retries", type=int, default=1, help="retries for a tool that fails or times out")
+    parser.add_argument("--artifact-cache", default="",
+                        help="directory of MZmine and Morpheus outputs reused when a raw file is reprocessed unchanged")
+    parser.add_argument("--enqueue", action="store_true",
+                        help="add the raw files to the job_queue table instead of processing them")
+    parser.add_argument("--reset", action="store_true",
+                        help="with --enqueue, queue raw files again that are already done or failed")
+    parser.add_argument("--worker", action="store_true",
+                        help="process raw files from the job_queue table, with --watch keep polling every --interval")
+    parser.add_argument("--lease", type=int, default=900,
+                        help="seconds a claimed job is held without a heartbeat before another worker can take it")
+    parser.add_argument("--ram", type=float, default=0, help="GB of RAM the tools can use (default all)")
+    parser.add_argument("--cpus", type=int, default=0, help="CPU cores the tools can use (default all)")
+    parser.add_argument("--footprints", default="",
+                        help="tool GB:cores eg. msconvert=1:1,mzmine=4:2,morpheus=2:4 (see ResourceGovernor)")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and only process raw files not already in the file index")
+    parser.add_argument("--interval", type=int, default=300, help="seconds between polls when watching")
+    parser.add_argument("--index", default="",
+                        help="file index location when watching (default file_index_<venue>_<experiment>.json)")
+    args = parser.parse_args()
+
+    # set database details, put in config file
+    db_info = {"user": "root", "password": "", "database": "mpmfdb"}
+    loc = args.venue.upper().strip()
+    experiment_type = args.experiment.upper().strip()
+    options = {"workers": args.workers, "pipeline": args.pipeline, "queue_size": max(args.queue_size, 1),
+               "batch_size": args.batch_size,
+               "settings": {"skip": [step.strip().lower() for step in args.skip.split(",") if step.strip()],
+                            "scratch": args.scratch, "scratch_size": int(args.scratch_size * 1024 ** 3),
+                            "work_dir": args.work_dir, "artifact_cache": args.artifact_cache,
+                            "timeouts": get_timeouts(args.timeouts), "retries": max(args.retries, 0),
+                            "publish": [pattern.strip() for pattern in args.publish.split(",") if pattern.strip()]},
+               "stage_workers": get_stage_workers(args.stage_workers)}
+
+    # admit tools by RAM and cores, shared across processes when there are several
+    footprints = get_footprints(args.footprints)
+    if args.workers > 1:
+        manager = mp.Manager()
+        governor = ResourceGovernor.shared(manager, args.ram, args.cpus, footprints)
+    else:
+        governor = ResourceGovernor(args.ram, args.cpus, footprints)
+    options["settings"]["governor"] = governor
 
+    # get file system (x 2) and database objects
+    fs = FileSystem(args.in_dir, "", "", "")
+    fs2 = FileSystem(args.in_dir, args.out_dir, loc, experiment_type) # used in processing and chrom
+    db = MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], fs)
 
+    # PROTEOMICS in_dir "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\qc_automation"
+    # METABOLOMICS in_dir "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\Metabolomics\QC_runs"
 
+    # get machine names for venue and experiment type
+    raw_dirs = None
+    machine_names = get_machine_names(db, loc, experiment_type)
+
+    # get raw file locations
+    if machine_names:
+        raw_dirs = get_raw_file_dirs(fs, loc, experiment_type, machine_names)
+
+    if not args.worker and not args.enqueue and \
+            not db.get_lock("mpmf_" + loc.lower() + "_" + experiment_type.lower(), 0):
+        # one run per venue and experiment (workers share the job queue instead), MySQL releases the lock
+        # if the process dies so there is no lockfile to clear
+        print("Already running for " + loc + " " + experiment_type)
+    elif args.worker:
+        # raw files come from the job queue, see --enqueue
+        start_workers(experiment_type, fs2, db_info, loc, options, args.interval if args.watch else 0, args.lease)
+    elif raw_dirs:
+        # directory listings are cached between runs
+        scanner = DirScanner(fs.main_dir + "\\" + "scan_cache_" + loc.lower() + "_" + experiment_type.lower() + ".json",
+                             settle=args.settle)
+        if args.backfill:
+            # history (eg. rebuilding after a database reset), no threshold emails for old runs
+            machine_filter = [machine.strip().lower() for machine in args.machines.split(",") if machine.strip()]
+            if "email" not in options["settings"]["skip"]:
+                options["settings"]["skip"].append("email")
+            machines = get_backfill_files(raw_dirs, machine_filter, args.from_date, args.to_date, scanner, args.settle)
+            backfill(machines, experiment_type, fs2, db_info, loc, db, options)
+        elif args.watch:
+            # new arrivals only, using the persisted file index
+            index_file = args.index
+            if index_file == "":
+                index_file = fs.main_dir + "\\" + "file_index_" + loc.lower() + "_" + experiment_type.lower() + ".json"
+            index = FileIndex(index_file)
+            watch(raw_dirs, index, scanner, experiment_type, fs2, db_info, loc, db, options, args.interval,
+                  max(args.limit, 1), args.settle)
+        elif args.enqueue:
+            machines = get_raw_files(raw_dirs, scanner, args.settle, args.limit)
+            enqueue(machines, experiment_type, loc, db, args.limit, args.reset)
+        else:
+            # get raw files, process them and update stats per machine
+            machines = get_raw_files(raw_dirs, scanner, args.settle, args.limit)
+            process_machines(machines, experiment_type, fs2, db_info, loc, db, args.limit, options)
@@ -0,0 +1,81 @@
+import os
+import ctypes
+import threading
+from contextlib import contextmanager
+
+
+class ResourceGovernor:
+    """
+        Admits the heavy external tools (msconvert, MZmine, Morpheus) only while their RAM and CPU footprints
+        fit the host, so the parallel modes don't run several JVMs or all-core Morpheus runs at once and swap
+        A tool waits until enough running tools finish, a tool bigger than the host runs on its own
+        Shared between processes by building it on a multiprocessing Manager (see shared)
+        Used by ToolRunner
+    """
+    # GB of RAM and CPU cores per run, mzmine heap is set in startMZmine_Windows.bat
+    FOOTPRINTS = {"msconvert": [1, 1], "mzmine": [4, 2], "morpheus": [2, max(1, (os.cpu_count() or 2) // 2)]}
+
+    def __init__(self, ram=0, cpus=0, footprints=None, condition=None, used=None):
+        self.ram = ram or get_total_ram()
+        self.cpus = cpus or os.cpu_count() or 1
+        self.footprints = dict(self.FOOTPRINTS)
+        self.footprints.update(footprints or {})
+        self.condition = condition or threading.Condition()
+        self.used = used if used is not None else {"ram": 0, "cpu": 0, "running": 0}
+
+    @classmethod
+    def shared(cls, manager, ram=0, cpus=0, footprints=None):
+        # a governor that can be passed to pool and worker processes
+        used = manager.dict({"ram": 0, "cpu": 0, "running": 0})
+        return cls(ram, cpus, footprints, manager.Condition(), used)
+
+    @contextmanager
+    def admit(self, tool):
+        ram, cpu = self.footprints.get(tool, [0, 0])
+        with self.condition:
+            while not self.fits(ram, cpu):
+                self.condition.wait()
+            self.used["ram"] = self.used["ram"] + ram
+            self.used["cpu"] = self.used["cpu"] + cpu
+            self.used["running"] = self.used["running"] + 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used["ram"] = self.used["ram"] - ram
+                self.used["cpu"] = self.used["cpu"] - cpu
+                self.used["running"] = self.used["running"] - 1
+                self.condition.notify_all()
+
+    def fits(self, ram, cpu):
+        if self.used["running"] == 0:
+            return True
+        return self.used["ram"] + ram <= self.ram and self.used["cpu"] + cpu <= self.cpus
+
+
+def get_total_ram():
+    # GB of physical memory, 16 if it can't be found
+    try:
+        if os.name == "nt":
+            class MemoryStatus(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+            status = MemoryStatus()
+            status.dwLength = ctypes.sizeof(MemoryStatus)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return status.ullTotalPhys / 1024 ** 3
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    except Exception as e:
+        print(e)
+        return 16
+
+
+if __name__ == "__main__":
+    # TESTING
+    governor = ResourceGovernor()
+    print(governor.ram, governor.cpus, governor.footprints)
+    with governor.admit("mzmine"):
+        print(governor.used)
@@ -0,0 +1,151 @@
+from MPMF_Json_File import load_json, save_json
+import os
+import time
+import hashlib
+from contextlib import contextmanager
+
+CHUNK = 1024 * 1024 * 8
+
+
+def file_md5(path, outfile=None):
+    # md5 of a file read in chunks, each chunk is also written to outfile if given (see ScratchCache.copy)
+    md5 = hashlib.md5()
+    with open(path, 'rb') as infile:
+        while True:
+            chunk = infile.read(CHUNK)
+            if not chunk:
+                break
+            md5.update(chunk)
+            if outfile is not None:
+                outfile.write(chunk)
+    return md5.hexdigest()
+
+
+class ScratchCache:
+    """
+        Local disk copies of raw files from the network share
+        Each raw file is copied once (checksum verified) and msconvert, Morpheus and
+        MSFileReader (ThermoMetrics) read the local copy instead of the share
+        Least recently used copies are removed to keep the cache under max_bytes
+        The manifest is shared by the pool workers, each read-modify-write holds manifest.lock
+        Used by ProcessRawFile
+    """
+    STALE_LOCK = 300 # seconds, a lock older than this was left by a worker that died
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.manifest_file = self.cache_dir + "\\" + "manifest.json"
+        self.lock_file = self.cache_dir + "\\" + "manifest.lock"
+        self.manifest = {} # raw file name: {"size", "mtime", "md5", "used"}
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with self.locked():
+            self.load()
+
+    @contextmanager
+    def locked(self):
+        # lock file shared with the other workers, the copy itself is done without it
+        while True:
+            try:
+                os.close(os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_file) > self.STALE_LOCK:
+                        os.remove(self.lock_file)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.1)
+        try:
+            yield
+        finally:
+            os.remove(self.lock_file)
+
+    def load(self):
+        self.manifest = load_json(self.manifest_file, {}, "scratch manifest")
+
+    def save(self):
+        save_json(self.manifest_file, self.manifest)
+
+    def fetch(self, raw_file):
+        """Returns the path of a verified local copy of raw_file"""
+        name = os.path.basename(raw_file)
+        local_file = self.cache_dir + "\\" + name
+        stat = os.stat(raw_file)
+
+        # reuse the copy if the raw file hasn't changed since it was copied
+        with self.locked():
+            self.load()
+            entry = self.manifest.get(name)
+            if entry is not None and os.path.isfile(local_file) and entry["size"] == stat.st_size \
+                    and entry["mtime"] == stat.st_mtime and os.path.getsize(local_file) == stat.st_size:
+                entry["used"] = time.time()
+                self.save()
+                return local_file
+
+            self.evict(stat.st_size, name)
+
+        # copy and hash the share in one read, then check the local copy against it
+        source_md5 = self.copy(raw_file, local_file)
+        if file_md5(local_file) != source_md5:
+            os.remove(local_file)
+            raise IOError("Scratch copy checksum mismatch " + name)
+
+        with self.locked():
+            self.load()
+            self.manifest[name] = {"size": stat.st_size, "mtime": stat.st_mtime, "md5": source_md5,
+                                   "used": time.time()}
+            self.save()
+        return local_file
+
+    def copy(self, source, destination):
+        temp_file = destination + ".part"
+        with open(temp_file, 'wb') as outfile:
+            md5 = file_md5(source, outfile)
+        os.replace(temp_file, destination)
+        return md5
+
+    def evict(self, needed, keep):
+        # remove least recently used copies until there is room for needed bytes, called holding the lock
+        self.reconcile()
+        total = sum([self.manifest[name]["size"] for name in self.manifest if name != keep])
+        for name in sorted(self.manifest, key=lambda x: self.manifest[x]["used"]):
+            if total + needed <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(self.cache_dir + "\\" + name)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # still open by another worker, try the next one
+                print(e)
+                continue
+            total -= self.manifest.pop(name)["size"]
+        self.save()
+
+    def reconcile(self):
+        # copies on disk without a manifest entry (eg. from before the lock) still count towards max_bytes,
+        # entries whose copy has gone are dropped
+        names = []
+        with os.scandir(self.cache_dir) as entries:
+            for dir_entry in entries:
+                if dir_entry.is_file() and not dir_entry.name.endswith((".json", ".lock", ".part", ".tmp")):
+                    names.append(dir_entry.name)
+                    if dir_entry.name not in self.manifest:
+                        stat = dir_entry.stat()
+                        self.manifest[dir_entry.name] = {"size": stat.st_size, "mtime": stat.st_mtime, "md5": "",
+                                                         "used": stat.st_mtime}
+        for name in list(self.manifest):
+            if name not in names:
+                self.manifest.pop(name)
+
+
+if __name__ == "__main__":
+    # TESTING
+    cache = ScratchCache("C:\\QC_Scratch", 50 * 1024 ** 3)
+    print(cache.fetch("Z:\\qc_automation\\fusion\\instrument_data\\HelaiRT1ul_190722200502.raw"))
@@ -0,0 +1,65 @@
+from MPMF_Database_SetUp import MPMFDBSetUp
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import comtypes # MSFileReader (ThermoMetrics) is COM, each thread needs COM initialised
+except ImportError:
+    comtypes = None
+
+
+class StageExecutor:
+    """
+        Runs independent post-ingest stages for a raw file at the same time
+        eg. ThermoMetrics (raw file controller traces) and Chromatogram (.mzmine file)
+        Each stage gets its own database connection and is called as stage(*args, db)
+        With a unit (see MPMFDBSetUp.staged_run) the stages' writes are staged and committed with the run's
+        Threads are used so it can run inside a multiprocessing pool worker
+        Used by process_raw_file in MPMF_Process_Raw_Files
+    """
+    def __init__(self, db_info, filesystem, unit=None):
+        self.db_info = db_info
+        self.fs = filesystem
+        self.unit = unit
+        self.stages = []
+
+    def add(self, name, stage, *args):
+        self.stages.append((name, stage, args))
+
+    def run(self):
+        # returns {stage name: True if completed}
+        results = {}
+        if len(self.stages) == 0:
+            return results
+
+        with ThreadPoolExecutor(max_workers=len(self.stages)) as executor:
+            futures = {}
+            for name, stage, args in self.stages:
+                futures[name] = executor.submit(self.run_stage, name, stage, args)
+            for name in futures:
+                results[name] = futures[name].result()
+
+        return results
+
+    def run_stage(self, name, stage, args):
+        if comtypes is not None:
+            comtypes.CoInitialize()
+        db = MPMFDBSetUp(self.db_info["user"], self.db_info["password"], self.db_info["database"], self.fs)
+        db.join(self.unit)
+
+        completed = False
+        try:
+            stage(*args, db)
+            completed = True
+        except SystemExit:
+            # Chromatogram exits if the .mzmine file is missing
+            print("Stage " + name + " exited")
+        except Exception as e:
+            print(e)
+            print("Stage " + name + " error")
+        finally:
+            db.join(None)
+            db.close()
+            if comtypes is not None:
+                comtypes.CoUninitialize()
+
+        return completed
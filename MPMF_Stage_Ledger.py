@@ -0,0 +1,58 @@
+from MPMF_File_System import FileSystem
+from MPMF_Database_SetUp import MPMFDBSetUp
+
+
+class StageLedger:
+    """
+        Persisted record of the processing stages completed for a raw file
+        Stored in the stage_ledger table so a restart can resume at the first incomplete stage
+        Used by ProcessRawFile
+    """
+    def __init__(self, file_name, db):
+        self.file_name = file_name
+        self.db = db
+        self.db.create_table_stage_ledger() # for databases set up before the ledger was added
+        self.completed = self.get_completed()
+
+    def get_completed(self):
+        sql = "SELECT stage FROM stage_ledger WHERE file_name = '" + self.file_name + "'"
+        try:
+            self.db.cursor.execute(sql)
+            return set([row[0] for row in self.db.cursor.fetchall()])
+        except Exception as e:
+            print(e)
+            return set()
+
+    def is_done(self, stage):
+        return stage in self.completed
+
+    def mark(self, stage):
+        sql = "INSERT INTO stage_ledger VALUES('" + self.file_name + "','" + stage + "', NOW())"
+        try:
+            self.db.execute(sql)
+            self.db.commit()
+            self.completed.add(stage)
+        except Exception as e:
+            print(e)
+
+    def clear(self, stages):
+        # forget stages so they are run again
+        for stage in stages:
+            if stage in self.completed:
+                sql = "DELETE FROM stage_ledger WHERE file_name = '" + self.file_name + "' AND stage = '" + stage + "'"
+                try:
+                    self.db.cursor.execute(sql)
+                    self.completed.discard(stage)
+                except Exception as e:
+                    print(e)
+        self.db.commit()
+
+
+if __name__ == "__main__":
+    # TESTING
+    db_info = {"user": "root", "password": "", "database": "mpmfdb"}
+    fs = FileSystem("", "", "", "")
+    db = MPMFDBSetUp(db_info["user"], db_info["password"], db_info["database"], fs)
+
+    ledger = StageLedger("HelaiRT1ul_190722200502", db)
+    print(ledger.completed)
@@ -18,6 +18,17 @@ class Stat:
         self.machine_type = m_type
 
     def run(self):
+        # one Stat per machine and experiment at a time (other machines, venues and experiments run alongside)
+        lock = "mpmf_stat_" + self.machine + "_" + self.e_type
+        if not self.db.get_lock(lock):
+            print("Stats locked for " + self.machine + " " + self.e_type)
+            return
+        try:
+            self.run_locked()
+        finally:
+            self.db.release_lock(lock)
+
+    def run_locked(self):
         if self.check_for_updates():
             self.compute_stats()
             self.insert_update_stats()
@@ -38,21 +49,22 @@ class Stat:
 
     def check_for_updates(self):
 
-        sql = "SELECT COUNT(*) FROM qc_run WHERE machine_id = " + \
+        sql = "SELECT run_id FROM qc_run WHERE machine_id = " + \
                 " (SELECT machine_id FROM machine WHERE machine_name = '" + \
                 self.machine + "') AND experiment_id = (SELECT experiment_id FROM experiment " + \
                 " WHERE experiment_type = '" + self.e_type.lower() + "')" + " AND completed = 'N'"
 
-        count = 0
+        # the runs these stats are computed with, runs finished after this aren't marked completed
+        self.new_runs = []
         try:
             self.db.db.commit() # not picking up commits in processing from other processes?
             self.db.cursor.execute(sql)
-            count = int(self.db.cursor.fetchone()[0])
-            #print(count)
+            self.new_runs = [str(row[0]) for row in self.db.cursor.fetchall()]
+            #print(len(self.new_runs))
         except Exception as e:
             print(e)
 
-        if count > 0:
+        if len(self.new_runs) > 0:
             return True
         else:
             return False
@@ -235,34 +247,15 @@ class Stat:
     def insert_update_morpheus_stats(self):
 
         # REFACTOR: remove Hela Digest hard code, get from file
-        sql_c = "SELECT component_id FROM sample_component WHERE component_name = 'Hela Digest'"
-
-        try:
-            self.db.cursor.execute(sql_c)
-            cid = self.db.cursor.fetchone()
-        except Exception as e:
-            print(e)
-
-        sql_mac = "SELECT machine_id FROM machine WHERE machine_name = '" + self.machine + "'"
-
-        try:
-            self.db.cursor.execute(sql_mac)
-            macid = self.db.cursor.fetchone()
-        except Exception as e:
-            print(e)
+        cid = self.db.get_component_id('Hela Digest')
+        macid = self.db.get_machine_id(self.machine)
 
         for i in range(len(self.hela_df)):
-            sql_m = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + self.hela_df.iloc[i]['Metric'] + "'"
+            mid = self.db.get_metric_id(self.hela_df.iloc[i]['Metric'])
 
-            try:
-                self.db.cursor.execute(sql_m)
-                mid = self.db.cursor.fetchone()
-            except Exception as e:
-                print(e)
-
-            if not self.is_inserted_stat(mid[0], cid[0], macid[0]):
-                sql = "INSERT into stat VALUES(" + "'" + str(mid[0]) + "','" + str(cid[0]) + "','" + \
-                             str(macid[0]) + "','"  + str(self.hela_df.iloc[i]['count']) + "','" + str(
+            if not self.is_inserted_stat(mid, cid, macid):
+                sql = "INSERT into stat VALUES(" + "'" + str(mid) + "','" + str(cid) + "','" + \
+                             str(macid) + "','"  + str(self.hela_df.iloc[i]['count']) + "','" + str(
                     self.hela_df.iloc[i]['mean']) + \
                              "','" + str(self.hela_df.iloc[i]['std']) + "','" + str(self.hela_df.iloc[i]['min']) + "','" + \
                              str(self.hela_df.iloc[i]['25%']) + "','" + str(self.hela_df.iloc[i]['50%']) + "','" + str(
@@ -274,8 +267,8 @@ class Stat:
                         "', std = '" + str(self.hela_df.iloc[i]['std']) + "', min = '" + str(self.hela_df.iloc[i]['min']) + \
                         "', 25_percent = '" + str(self.hela_df.iloc[i]['25%'])  + "', 50_percent = '" + str(self.hela_df.iloc[i]['50%'])  + \
                         "', 75_percent = '" + str(self.hela_df.iloc[i]['75%']) + "', max = '" + str(self.hela_df.iloc[i]['max'])  + \
-                        "' WHERE metric_id = '" + str(mid[0]) + "' AND component_id = '" + str(cid[0]) + \
-                        "' AND machine_id = '" + str(macid[0]) + "'"
+                        "' WHERE metric_id = '" + str(mid) + "' AND component_id = '" + str(cid) + \
+                        "' AND machine_id = '" + str(macid) + "'"
             try:
                 self.db.cursor.execute(sql)
             except Exception as e:
@@ -287,20 +280,14 @@ class Stat:
         # run after compute_stats()
         # columns = ['Component', 'Metric', 'Machine', 'count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
 
-        sql_mac = "SELECT machine_id FROM machine WHERE machine_name = '" + self.machine + "'"
-
-        try:
-            self.db.cursor.execute(sql_mac)
-            macid = self.db.cursor.fetchone()
-        except Exception as e:
-            print(e)
+        macid = self.db.get_machine_id(self.machine)
 
         for i in range(len(self.df)):
 
-            if not self.is_inserted_stat(self.df.iloc[i]['Metric'], self.df.iloc[i]['Component'], macid[0]):
+            if not self.is_inserted_stat(self.df.iloc[i]['Metric'], self.df.iloc[i]['Component'], macid):
                 sql = "INSERT into stat VALUES(" + "'" + str(self.df.iloc[i]['Metric']) + "','" + \
                       str(self.df.iloc[i]['Component']) + "','" + \
-                             str(macid[0]) + "','" + str(self.df.iloc[i]['count']) + "','" + \
+                             str(macid) + "','" + str(self.df.iloc[i]['count']) + "','" + \
                       str(self.df.iloc[i]['mean']) + \
                              "','" + str(self.df.iloc[i]['std']) + "','" + str(self.df.iloc[i]['min']) + "','" + \
                              str(self.df.iloc[i]['25%']) + "','" + str(self.df.iloc[i]['50%']) + "','" + \
@@ -312,7 +299,7 @@ class Stat:
                         "', 25_percent = '" + str(self.df.iloc[i]['25%'])  + "', 50_percent = '" + str(self.df.iloc[i]['50%'])  + \
                         "', 75_percent = '" + str(self.df.iloc[i]['75%']) + "', max = '" + str(self.df.iloc[i]['max'])  + \
                         "' WHERE metric_id = '" + str(self.df.iloc[i]['Metric']) + "' AND component_id = '" + str(self.df.iloc[i]['Component']) + \
-                        "' AND machine_id = '" + str(macid[0]) + "'"
+                        "' AND machine_id = '" + str(macid) + "'"
             try:
                 self.db.cursor.execute(sql)
             except Exception as e:
@@ -390,18 +377,13 @@ class Stat:
                             norm_min = norm
 
                     # get metric id
-                    get_mid = "SELECT metric_id FROM metric WHERE metric_name = " + "'" + metric + "_normalised" + "'"
-                    try:
-                        self.db.cursor.execute(get_mid)
-                        mid = self.db.cursor.fetchone()
-                    except Exception as e:
-                        print(e)
+                    mid = self.db.get_metric_id(metric + "_normalised")
 
                     # deleting means all values are updated using current stats
-                    if self.is_inserted_measurement(mid[0], value[1], value[3]):
-                        self.delete_measurement(mid[0], value[1], value[3])
+                    if self.is_inserted_measurement(mid, value[1], value[3]):
+                        self.delete_measurement(mid, value[1], value[3])
 
-                    insert_med = "INSERT INTO measurement VALUES('" + str(mid[0]) + "',' " + \
+                    insert_med = "INSERT INTO measurement VALUES('" + str(mid) + "',' " + \
                                  str(value[1]) + "','" + str(value[3]) + "','" + str(norm) + "')"
                     try:
                         self.db.cursor.execute(insert_med)
@@ -450,7 +432,8 @@ class Stat:
         sql = "UPDATE qc_run SET completed = 'Y' WHERE machine_id = " + \
             "(SELECT machine_id FROM machine WHERE machine_name = '" + \
             self.machine + "') AND experiment_id = (SELECT experiment_id FROM experiment " + \
-            " WHERE experiment_type = '" + self.e_type.lower() + "')"
+            " WHERE experiment_type = '" + self.e_type.lower() + "')" + \
+            " AND completed = 'N' AND run_id IN (" + ",".join(self.new_runs) + ")"
 
         try:
             self.db.cursor.execute(sql)
@@ -20,7 +20,7 @@ class ThermoMetrics:
         self.filename = filename
         self.rawfile = MSFileReader(self.filepath)
         self.db = db
-        self.db.db.commit() # commit for any other instances
+        self.db.commit() # commit for any other instances
         self.run_id = self.db.get_run_id(self.filename)
         self.comp_id = self.set_component_id()
 
@@ -88,16 +88,10 @@ class ThermoMetrics:
         # may need to get these comp names from file for config purposes
 
         if self.exp == "METABOLOMICS":
-            sql = "SELECT component_id FROM sample_component WHERE component_name = 'Metab Digest'"
+            return self.db.get_component_id('Metab Digest')
         elif self.exp == "PROTEOMICS":
-            sql = "SELECT component_id FROM sample_component WHERE component_name = 'Hela Digest'"
-
-        try:
-            self.db.cursor.execute(sql)
-            return self.db.cursor.fetchone()[0]
-        except Exception as e:
-            print(e)
-            return False
+            return self.db.get_component_id('Hela Digest')
+        return False
 
     def set_lp_data(self):
         self.rawfile.SetCurrentController(self.controller_type, self.lp_cont)
@@ -607,22 +601,17 @@ class ThermoMetrics:
     def insert_metrics(self, metrics):
         # INSERT (called by "all" functions)
         for metric in metrics:
-            sql = "SELECT metric_id FROM metric WHERE metric_name = '" + metric + "'"
-            try:
-                self.db.cursor.execute(sql)
-                metric_id = self.db.cursor.fetchone()[0]
-            except Exception as e:
-                print(e)
+            metric_id = self.db.get_metric_id(metric)
 
             insert_sql = "INSERT INTO measurement VALUES('" + str(metric_id) + "','" + \
                          str(self.comp_id) + "','" + str(self.run_id) + "','" + str(metrics[metric]) + "')"
 
             try:
-                self.db.cursor.execute(insert_sql)
+                self.db.execute(insert_sql)
             except Exception as e:
                 print(e)
 
-        self.db.db.commit()
+        self.db.commit()
 
     # PRESSURE PROFILES
     def create_data_bins(self, pump):
@@ -683,11 +672,11 @@ class ThermoMetrics:
         sql = "INSERT INTO pressure_profile VALUES(NULL,'" + json_data + "','" + str(pump) + "','" + str(self.run_id) + "')"
 
         try:
-            self.db.cursor.execute(sql)
+            self.db.execute(sql)
         except Exception as e:
             print(e)
 
-        self.db.db.commit()
+        self.db.commit()
 
     # TEST
     def check_json(self, pump):
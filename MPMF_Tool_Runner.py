@@ -0,0 +1,111 @@
+import os
+import signal
+import subprocess
+import time
+
+
+class ToolRunner:
+    """
+        Runs an external tool (msconvert, MZmine, Morpheus) with a timeout and bounded retries
+        On timeout the whole process tree is killed (shell, batch file, JVM) so a hung tool
+        can't hold up the files behind it
+        Output is captured to log_file and each attempt is classified as ok, timeout, not_found or failed
+        Each attempt waits for the settings' ResourceGovernor (if any) to admit the tool
+        Used by ProcessRawFile, MZmineBatch and MorpheusBatch
+    """
+    # seconds per run, None for no limit
+    TIMEOUTS = {"msconvert": 1800, "mzmine": 3600, "morpheus": 7200}
+    RETRY = ["timeout", "failed"]
+
+    def __init__(self, tool, settings=None, log_file="", scale=1):
+        settings = settings or {}
+        self.tool = tool
+        self.timeout = settings.get("timeouts", {}).get(tool, self.TIMEOUTS.get(tool))
+        if self.timeout:
+            self.timeout = self.timeout * scale # eg. number of files in a batch
+        self.retries = settings.get("retries", 1)
+        self.governor = settings.get("governor")
+        self.log_file = log_file
+        self.status = ""
+        self.returncode = None
+
+    def run(self, command, cwd):
+        # returns True if the tool exited with 0
+        for attempt in range(self.retries + 1):
+            if self.governor is not None:
+                with self.governor.admit(self.tool):
+                    self.status = self.run_once(command, cwd)
+            else:
+                self.status = self.run_once(command, cwd)
+            if self.status == "ok":
+                return True
+
+            print(self.tool + ": " + self.status + " (exit " + str(self.returncode) + "), attempt "
+                  + str(attempt + 1) + " of " + str(self.retries + 1))
+            if self.status not in self.RETRY:
+                break
+
+        return False
+
+    def run_once(self, command, cwd):
+        # own process group so the tree can be killed
+        kwargs = {}
+        if os.name == "nt":
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+
+        started = time.time()
+        process = subprocess.Popen(command, cwd=cwd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   **kwargs)
+        timed_out = False
+        try:
+            output = process.communicate(timeout=self.timeout)[0]
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            self.kill_tree(process)
+            output = process.communicate()[0]
+
+        self.returncode = process.returncode
+        status = self.classify(timed_out)
+        self.log(command, output, status, time.time() - started)
+        return status
+
+    def classify(self, timed_out):
+        if timed_out:
+            return "timeout"
+        if self.returncode == 0:
+            return "ok"
+        # command not found from cmd.exe (9009) or sh (127), retrying won't help
+        if self.returncode in [9009, 127]:
+            return "not_found"
+        return "failed"
+
+    def kill_tree(self, process):
+        try:
+            if os.name == "nt":
+                subprocess.call("taskkill /F /T /PID " + str(process.pid), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except Exception as e:
+            print(e)
+            process.kill()
+
+    def log(self, command, output, status, seconds):
+        if self.log_file == "":
+            return
+        try:
+            with open(self.log_file, 'a') as outfile:
+                outfile.write(time.strftime("%Y-%m-%d %H:%M:%S") + " " + self.tool + " " + status + " exit "
+                              + str(self.returncode) + " " + str(round(seconds)) + " sec\n")
+                outfile.write(command + "\n")
+                outfile.write(output.decode(errors="replace") + "\n")
+        except Exception as e:
+            print(e)
+
+
+if __name__ == "__main__":
+    # TESTING
+    runner = ToolRunner("msconvert", {"timeouts": {"msconvert": 5}, "retries": 0})
+    print(runner.run("msconvert --help", os.getcwd()), runner.status)
@@ -7,33 +7,21 @@
 SETLOCAL ENABLEEXTENSIONS ENABLEDELAYEDEXPANSION
 SET me=%~n0
 
-IF EXIST "D:\mpmf_qc_scripts\parkville_metabolomics.txt" (
-    ECHO %me% >> D:\mpmf_qc_scripts\update_log.txt
-    ECHO Script already running.. >> D:\mpmf_qc_scripts\update_log.txt
-    ECHO %DATE% >> D:\mpmf_qc_scripts\update_log.txt
-    ECHO %TIME% >> D:\mpmf_qc_scripts\update_log.txt
-    
-) ELSE (
-    :: create temp file
-    type NUL > parkville_metabolomics.txt
-	
-	:: logging
-    ECHO %me% >> D:\mpmf_qc_scripts\update_log.txt
-    ECHO Starting update.. >> D:\mpmf_qc_scripts\update_log.txt
-    ECHO %DATE% >> D:\mpmf_qc_scripts\update_log.txt
-    ECHO %TIME% >> D:\mpmf_qc_scripts\update_log.txt
-    
-    :: activate conda
-    CALL C:\ProgramData\Miniconda3\Scripts\activate.bat
+:: no lockfile, MPMF_Process_Raw_Files holds a MySQL lock per venue and experiment
+:: (released if it dies) and exits if another run has it
 
-    :: run script
-    cd D:\Processing-Quality-Control-Pipeline
-    python MPMF_Process_Raw_Files.py "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\Metabolomics\QC_runs" "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\Metabolomics\QC_runs\QC_outfiles" "parkville" "metabolomics"
+:: logging
+ECHO %me% >> D:\mpmf_qc_scripts\update_log.txt
+ECHO Starting update.. >> D:\mpmf_qc_scripts\update_log.txt
+ECHO %DATE% >> D:\mpmf_qc_scripts\update_log.txt
+ECHO %TIME% >> D:\mpmf_qc_scripts\update_log.txt
 
-    :: delete the temp file
-    del "D:\mpmf_qc_scripts\parkville_metabolomics.txt" /q
-      
-)
+:: activate conda
+CALL C:\ProgramData\Miniconda3\Scripts\activate.bat
+
+:: run script
+cd D:\Processing-Quality-Control-Pipeline
+python MPMF_Process_Raw_Files.py "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\Metabolomics\QC_runs" "\\storage.erc.monash.edu\Shares\R-MNHS-MBPF\Shared\Metabolomics\QC_runs\QC_outfiles" "parkville" "metabolomics"
 
 :END
 ENDLOCAL
@@ -0,0 +1,35 @@
+import math
+import pytest
+
+pd = pytest.importorskip("pandas")
+process = pytest.importorskip("MPMF_Process_Raw_Files")
+
+
+def make_run(tmp_path):
+    # a ProcessRawFile without a database, components from a fixed table
+    qc_run = process.ProcessRawFile.__new__(process.ProcessRawFile)
+    qc_run.outfiles_dir = str(tmp_path)
+    qc_run.file_name = "HelaiRT1ul_190722200502"
+    qc_run.get_components = lambda: pd.DataFrame({"component": ["A", "B", "C"], "component_id": [1, 2, 3],
+                                                  "exp_mass_charge": [500.0, 600.0, float("nan")]})
+    return qc_run
+
+
+def test_non_finite_values_put_to_zero(tmp_path):
+    header = "row identity|" + "|".join(process.ProcessRawFile.MZMINE_COLUMNS) + "|"
+    rows = ["A|500.001|10.1|1000|2000|0.1|1.1|1.2|499.9|500.1|",
+            "B|600.002|11.2|NaN|Infinity|0.2|null||599.9|600.1|",
+            "C|700.0|12.3|-Infinity|3000|0.3|1.0|1.0|699.9|700.1|"]
+    with open(str(tmp_path) + "\\" + "posoutput.csv", "w") as outfile:
+        outfile.write("\n".join([header] + rows) + "\n")
+
+    peaks = make_run(tmp_path).read_mzmine_csv("posoutput.csv")
+
+    assert list(peaks["component_id"]) == [1, 2, 3]
+    columns = process.ProcessRawFile.MZMINE_COLUMNS + process.ProcessRawFile.DERIVED_COLUMNS
+    for value in peaks[columns].values.ravel():
+        assert math.isfinite(float(value))
+    b = peaks[peaks["component"] == "B"].iloc[0]
+    assert (b["height"], b["area"], b["tf"], b["af"]) == (0, 0, 0, 0)
+    assert peaks[peaks["component"] == "A"].iloc[0]["area"] == 2000
+    assert peaks[peaks["component"] == "C"].iloc[0]["mass_error_ppm"] == 0